@@ -1,8 +1,35 @@
 # Base class for search engine adapter
+import json
+import logging
+import os
+import threading
+
+from base.lru_cache import LRUCache
+from metrics import metrics
+
 
 class SearchEngineBase:
-    def __init__(self, *args, **kwargs):
-        pass
+    # Bumped on every add so that caches of search-derived results can
+    # tell when the index has changed
+    generation_file = 'data/index_generation'
+    # Subclasses that do not call __init__ search uncached
+    search_cache = None
+
+    def __init__(self, *args, cache_size=0, cache_ttl=None,
+                 cache_max_bytes=None, generation_file=None, **kwargs):
+        '''With cache_size > 0, search results are kept in an LRU cache
+        of at most cache_size entries and cache_max_bytes bytes of hits
+        that entries leave after cache_ttl seconds or once the index
+        generation changes. Indexes rebuilt on their own schedule keep
+        their generation in a separate generation_file.'''
+        if generation_file:
+            self.generation_file = generation_file
+        if cache_size and int(cache_size) > 0:
+            self.search_cache = LRUCache(
+                max_entries=int(cache_size), ttl=cache_ttl,
+                max_bytes=int(cache_max_bytes) if cache_max_bytes else None)
+            self.cache_generation = None
+            self.cache_lock = threading.Lock()
 
     def _add(self, documents, *args, **kwargs):
         pass
@@ -10,8 +37,82 @@ class SearchEngineBase:
     def _search(self, query, n, *args, **kwargs):
         pass
 
+    def _rebuild(self, documents, *args, **kwargs):
+        pass
+
     def add(self, documents, *args, **kwargs):
-        return self._add(documents, *args, **kwargs)
+        result = self._add(documents, *args, **kwargs)
+        self.bump_generation()
+        return result
+
+    def rebuild(self, documents, *args, **kwargs):
+        '''Replace all indexed documents with documents so that searches
+        see either the old or the new ones. Without documents the index is
+        kept as it is.'''
+        documents = list(documents)
+        if not documents:
+            logging.warning('No documents to rebuild the index from - '
+                            'keeping the current one')
+            return 0, 0
+        result = self._rebuild(documents, *args, **kwargs)
+        self.bump_generation()
+        return result
+
+    def get_ids(self):
+        '''Set of the ids of all indexed documents'''
+        raise NotImplementedError
 
     def search(self, query, n, *args, **kwargs):
-        return self._search(query, n, *args, **kwargs)
+        if self.search_cache is None:
+            return self._search(query, n, *args, **kwargs)
+        generation = self.generation()
+        with self.cache_lock:
+            if generation != self.cache_generation:
+                self.search_cache.clear()
+                self.cache_generation = generation
+        # The timeout does not change the results
+        key = json.dumps(
+            [query, n, args,
+             {k: v for k, v in kwargs.items() if k != 'timeout'}],
+            sort_keys=True, default=str)
+        cached = self.search_cache.get(key)
+        if cached is not None:
+            metrics.inc('search_cache_hits')
+            return self._deserialize_hits(cached)
+        metrics.inc('search_cache_misses')
+        results = self._search(query, n, *args, **kwargs)
+        data = self._serialize_hits(results)
+        # Hits carry whole documents, so the entry count alone does not
+        # bound memory
+        self.search_cache.put(key, data, size=self._hits_size(data))
+        metrics.set('search_cache_bytes', self.search_cache.n_bytes)
+        return results
+
+    def _serialize_hits(self, results):
+        '''Turn search results into a form that is safe to keep around'''
+        return list(results)
+
+    def _deserialize_hits(self, data):
+        '''Rebuild search results from _serialize_hits output'''
+        return list(data)
+
+    def _hits_size(self, data):
+        '''Approximate size in bytes of _serialize_hits output'''
+        return len(json.dumps(data, default=str))
+
+    def generation(self):
+        '''Current index generation (0 if the index was never updated)'''
+        try:
+            with open(self.generation_file, 'r') as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump_generation(self):
+        '''Mark the index as changed'''
+        generation = self.generation() + 1
+        os.makedirs(os.path.dirname(self.generation_file) or '.',
+                    exist_ok=True)
+        with open(self.generation_file, 'w') as f:
+            f.write(str(generation))
+        return generation
@@ -2,7 +2,7 @@ import requests
 import pandas as pd
 
 
-def read_data_json(typename, api, body):
+def read_data_json(typename, api, body, timeout=None):
     """
     read_data_json directly accesses the C3.ai COVID-19 Data Lake APIs using the requests library, 
     and returns the response as a JSON, raising an error if the call fails for any reason.
@@ -10,6 +10,7 @@ def read_data_json(typename, api, body):
     typename: The type you want to access, i.e. 'OutbreakLocation', 'LineListRecord', 'BiblioEntry', etc.
     api: The API you want to access, either 'fetch' or 'evalmetrics'.
     body: The spec you want to pass. For examples, see the API documentation.
+    timeout: Seconds to wait for the response. The default is None (wait forever).
     """
     response = requests.post(
         "https://api.c3.ai/covid/api/1/" + typename + "/" + api,
@@ -17,7 +18,8 @@ def read_data_json(typename, api, body):
         headers={
             'Accept': 'application/json',
             'Content-Type': 'application/json'
-        }
+        },
+        timeout=timeout
     )
 
     # if request failed, show exception
@@ -63,7 +65,7 @@ def fetch(typename, body, get_all=False, remove_meta=True):
     return df
 
 
-def evalmetrics(typename, body, get_all=False, remove_meta=True):
+def evalmetrics(typename, body, get_all=False, remove_meta=True, timeout=None):
     """
     evalmetrics accesses the C3.ai COVID-19 Data Lake using read_data_json, and converts the response into a Pandas dataframe.
     evalmetrics is used for all timeseries data in the C3.ai COVID-19 Data Lake.
@@ -72,6 +74,7 @@ def evalmetrics(typename, body, get_all=False, remove_meta=True):
     body: The spec you want to pass. For examples, see the API documentation.
     get_all: If True, get all metrics and ignore limits on number of expressions and ids. If False, consider expressions and ids limits. The default is False.
     remove_meta: If True, remove metadata about each record. If False, include it. The default is True.
+    timeout: Seconds to wait for each response. The default is None (wait forever).
     """
     if get_all:
         expressions = body['spec']['expressions']
@@ -84,13 +87,15 @@ def evalmetrics(typename, body, get_all=False, remove_meta=True):
                     ids=ids[ids_start: ids_start + 10],
                     expressions=expressions[expressions_start: expressions_start + 4]
                 )
-                response_json = read_data_json(typename, 'evalmetrics', body)
+                response_json = read_data_json(
+                    typename, 'evalmetrics', body, timeout=timeout)
                 new_df = pd.json_normalize(response_json['result'])
                 new_df = new_df.apply(pd.Series.explode)
                 df = pd.concat([df, new_df], axis=1)
 
     else:
-        response_json = read_data_json(typename, 'evalmetrics', body)
+        response_json = read_data_json(
+            typename, 'evalmetrics', body, timeout=timeout)
         df = pd.json_normalize(response_json['result'])
         df = df.apply(pd.Series.explode)
 
@@ -0,0 +1,206 @@
+# Hybrid dense + lexical search over a memory-mapped embedding matrix
+import json
+import logging
+import os
+import threading
+
+import numpy as np
+
+from .base.search_engine import SearchEngineBase
+
+
+class Encoder:
+    '''Mean-pooled, L2-normalized sentence embeddings on CPU'''
+
+    def __init__(self, model_name='sentence-transformers/all-MiniLM-L6-v2',
+                 max_len=256):
+        import torch
+        from transformers import AutoModel, AutoTokenizer
+        self.torch = torch
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name)
+        self.model = AutoModel.from_pretrained(model_name).eval()
+        self.max_len = max_len
+        # Tokenizers and torch modules are not safe to share across
+        # request threads
+        self.lock = threading.Lock()
+
+    def encode(self, texts, batch_size=64):
+        embeddings = []
+        with self.lock:
+            for b in range(0, len(texts), batch_size):
+                batch = self.tokenizer(texts[b:b+batch_size], padding=True,
+                                       truncation=True,
+                                       max_length=self.max_len,
+                                       return_tensors='pt')
+                with self.torch.no_grad():
+                    tokens = self.model(**batch)[0]
+                mask = batch['attention_mask'].unsqueeze(-1).float()
+                pooled = (tokens * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+                embeddings.append(pooled.numpy())
+        embeddings = np.concatenate(embeddings).astype(np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True) \
+            .clip(min=1e-9)
+        return embeddings
+
+
+def passage_text(doc):
+    '''Text of a document that is embedded'''
+    return f'{doc.get("title") or ""}. {doc.get("abstract") or ""}'.strip()
+
+
+def kmeans(x, n_lists, n_iter=10, seed=0):
+    '''Spherical k-means centroids of the rows of x'''
+    rng = np.random.default_rng(seed)
+    centroids = x[rng.choice(len(x), n_lists, replace=False)].copy()
+    for _ in range(n_iter):
+        assign = (x @ centroids.T).argmax(axis=1)
+        for c in range(n_lists):
+            members = x[assign == c]
+            if len(members):
+                centroids[c] = members.mean(axis=0)
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) \
+            .clip(min=1e-9)
+    return centroids
+
+
+def build_dense_index(docs, n_docs, index_dir='data/dense_index',
+                      model_name='sentence-transformers/all-MiniLM-L6-v2',
+                      batch_size=256, n_lists=0, sample_size=50000):
+    '''
+    Embed docs (an iterable of n_docs documents) into a memory-mapped
+    matrix under index_dir. With n_lists > 0, rows are also partitioned
+    into an inverted file (IVF) of n_lists clusters.
+    '''
+    encoder = Encoder(model_name)
+    os.makedirs(index_dir, exist_ok=True)
+    dim = encoder.encode(['dimension probe']).shape[1]
+    path = os.path.join(index_dir, 'embeddings.npy')
+    matrix = np.lib.format.open_memmap(path, mode='w+', dtype=np.float32,
+                                       shape=(n_docs, dim))
+    ids = []
+    batch = []
+
+    def flush():
+        matrix[len(ids) - len(batch):len(ids)] = encoder.encode(
+            [passage_text(d) for d in batch], batch_size=64)
+        batch.clear()
+        logging.info(f'Embedded {len(ids)}/{n_docs} documents')
+    for doc in docs:
+        ids.append(doc['id'])
+        batch.append(doc)
+        if len(batch) == batch_size:
+            flush()
+    if batch:
+        flush()
+    matrix.flush()
+    with open(os.path.join(index_dir, 'ids.json'), 'w') as f:
+        json.dump(ids, f)
+    if int(n_lists) > 0:
+        rng = np.random.default_rng(0)
+        sample = matrix[np.sort(rng.choice(
+            len(ids), min(len(ids), int(sample_size)), replace=False))]
+        centroids = kmeans(np.asarray(sample), int(n_lists))
+        assign = np.concatenate([
+            (matrix[b:b+100000] @ centroids.T).argmax(axis=1)
+            for b in range(0, len(ids), 100000)])
+        order = np.argsort(assign, kind='stable')
+        offsets = np.searchsorted(assign[order], np.arange(int(n_lists) + 1))
+        np.save(os.path.join(index_dir, 'ivf_centroids.npy'), centroids)
+        np.save(os.path.join(index_dir, 'ivf_order.npy'), order)
+        np.save(os.path.join(index_dir, 'ivf_offsets.npy'), offsets)
+    logging.info(f'Dense index of {len(ids)} documents written to '
+                 f'{index_dir}')
+
+
+class DenseSearchAdapter(SearchEngineBase):
+    '''
+    Combines a lexical engine with nearest-neighbour search over document
+    embeddings using reciprocal rank fusion. Candidates are ranked on
+    ids alone and only the fused top n are fetched, with highlights, from
+    the lexical engine, so it must support ElasticSearchAdapter.rank_ids
+    and the ids argument of ElasticSearchAdapter._search.
+    '''
+
+    def __init__(self, lexical, index_dir='data/dense_index',
+                 model_name='sentence-transformers/all-MiniLM-L6-v2',
+                 n_candidates=100, n_probe=8, rrf_k=60, cache_size=0,
+                 cache_ttl=None, cache_max_bytes=None):
+        super().__init__(cache_size=cache_size, cache_ttl=cache_ttl,
+                         cache_max_bytes=cache_max_bytes)
+        self.lexical = lexical
+        self.encoder = Encoder(model_name)
+        self.n_candidates = int(n_candidates)
+        self.n_probe = int(n_probe)
+        self.rrf_k = rrf_k
+        # Pages are read on demand and shared through the OS page cache
+        self.matrix = np.load(os.path.join(index_dir, 'embeddings.npy'),
+                              mmap_mode='r')
+        with open(os.path.join(index_dir, 'ids.json'), 'r') as f:
+            self.ids = json.load(f)
+        self.ivf = None
+        centroids_file = os.path.join(index_dir, 'ivf_centroids.npy')
+        if os.path.exists(centroids_file):
+            self.ivf = (
+                np.load(centroids_file),
+                np.load(os.path.join(index_dir, 'ivf_order.npy')),
+                np.load(os.path.join(index_dir, 'ivf_offsets.npy')),
+            )
+        logging.info(f'Loaded {len(self.ids)} embeddings from {index_dir}'
+                     f'{" with IVF" if self.ivf else ""}')
+
+    def generation(self):
+        return self.lexical.generation()
+
+    def get_ids(self):
+        return self.lexical.get_ids()
+
+    def _add(self, documents, *args, **kwargs):
+        # Embeddings are rebuilt offline with build_index.py embed
+        return self.lexical.add(documents, *args, **kwargs)
+
+    def dense_search(self, query, n):
+        '''Ids of the n documents most similar to the query'''
+        q = self.encoder.encode([query])[0]
+        if self.ivf is None:
+            rows = None
+            scores = self.matrix @ q
+        else:
+            centroids, order, offsets = self.ivf
+            probe = np.argsort(-(centroids @ q))[:self.n_probe]
+            rows = np.sort(np.concatenate(
+                [order[offsets[c]:offsets[c+1]] for c in probe]))
+            scores = self.matrix[rows] @ q
+        n = min(n, len(scores))
+        if not n:
+            return []
+        top = np.argpartition(-scores, n - 1)[:n]
+        top = top[np.argsort(-scores[top])]
+        if rows is not None:
+            top = rows[top]
+        return [self.ids[i] for i in top]
+
+    def _search(self, query, n, *args, **kwargs):
+        lexical_ids = self.lexical.rank_ids(
+            query, self.n_candidates, *args, **kwargs)
+        dense_ids = self.dense_search(query, self.n_candidates)
+        # Reciprocal rank fusion
+        fused = {}
+        for ranking in (lexical_ids, dense_ids):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0) + \
+                    1 / (self.rrf_k + rank + 1)
+        top_ids = sorted(fused, key=fused.get, reverse=True)[:n]
+        if not top_ids:
+            return []
+        hits = {h.meta.id: h for h in self.lexical.search(
+            query, len(top_ids), *args, ids=top_ids, **kwargs)}
+        return [hits[i] for i in top_ids if i in hits]
+
+    def _serialize_hits(self, results):
+        return self.lexical._serialize_hits(results)
+
+    def _deserialize_hits(self, data):
+        return self.lexical._deserialize_hits(data)
+
+    def get_highlight_frags(self, doc, *args, **kwargs):
+        return self.lexical.get_highlight_frags(doc, *args, **kwargs)
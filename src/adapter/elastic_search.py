@@ -1,6 +1,10 @@
-from datetime import datetime
+import logging
+from time import time
+
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
 from elasticsearch_dsl import Document, Keyword, Text, Date, connections
-from elasticsearch_dsl.query import MultiMatch
+from elasticsearch_dsl.query import Bool, Ids, MultiMatch
+from elasticsearch_dsl.response import Hit
 
 from .base.search_engine import SearchEngineBase
 
@@ -21,50 +25,213 @@ class DefaultArticleMapping(Document):
         settings = {"number_of_shards": 1, "number_of_replicas": 0}
 
 
+class AuxPassageMapping(Document):
+    '''Passages of general reference pages (e.g. Wikipedia)'''
+    title = Text()
+    url = Keyword()
+    publishTime = Date()
+    body = Text(analyzer='snowball')
+
+    class Index:
+        name = "covidprof_aux"
+        settings = {"number_of_shards": 1, "number_of_replicas": 0}
+
+
 class ElasticSearchAdapter(SearchEngineBase):
-    def __init__(self, mapping=DefaultArticleMapping):
+    def __init__(self, mapping=DefaultArticleMapping, cache_size=0,
+                 cache_ttl=None, cache_max_bytes=None, generation_file=None):
+        super().__init__(cache_size=cache_size, cache_ttl=cache_ttl,
+                         cache_max_bytes=cache_max_bytes,
+                         generation_file=generation_file)
         # establish a persistent elasticsearch connection
-        connections.create_connection()
+        es = connections.create_connection()
         # set the mapping as an instance attribute, for use in the _add method
         self.mapping = mapping
         # push the mapping template to elasticsearch and initialize the index
-        self.mapping.init()
+        # (rebuilt indexes are reached through an alias of that name and
+        # already have it)
+        if not es.indices.exists_alias(name=self.mapping._index._name):
+            self.mapping.init()
+
+    def _actions(self, documents, index):
+        '''Turn documents into bulk index actions'''
+        for doc in documents:
+            source = {k: v for (k, v) in doc.items() if k != 'id'}
+            # publishTime is already ISO formatted, which Elasticsearch
+            # parses itself
+            if not source.get('publishTime'):
+                source['publishTime'] = None
+            yield {'_index': index, '_id': doc['id'], '_source': source}
+
+    def _set_load_settings(self, bulk_load, index):
+        '''Disable refresh and replicas for a bulk load and return the
+        settings to restore afterwards'''
+        if not bulk_load:
+            return None
+        es = connections.get_connection()
+        current = es.indices.get_settings(index=index)[index]['settings']
+        restore = {
+            'refresh_interval':
+                current['index'].get('refresh_interval'),
+            'number_of_replicas':
+                current['index'].get('number_of_replicas'),
+        }
+        es.indices.put_settings(index=index, body={'index': {
+            'refresh_interval': '-1',
+            'number_of_replicas': 0,
+        }})
+        return restore
 
-    def _add(self, documents):
+    def _add(self, documents, chunk_size=500, n_workers=1,
+             bulk_load=False, index=None):
+        '''Index documents in bulk requests of chunk_size documents, sent
+        from n_workers threads. With bulk_load, refresh and replicas are
+        turned off until all documents are in.'''
         if isinstance(documents, dict):
             documents = [documents]
-        for doc in documents:
-            doc_without_id = {k: v for (k, v) in doc.items() if k != "id"}
-            # convert publishTime from string to datetime if it exists
-            if doc_without_id['publishTime'] != '':
-                doc_without_id['publishTime'] = datetime.strptime(doc_without_id['publishTime'], '%Y-%m-%dT%H:%M:%S')
+        chunk_size = int(chunk_size)
+        n_workers = int(n_workers)
+        index = index or self.mapping._index._name
+        es = connections.get_connection()
+        restore = self._set_load_settings(bulk_load, index)
+        t0 = time()
+        n_ok = n_failed = 0
+        chunk_errors = []
+        try:
+            if n_workers > 1:
+                results = parallel_bulk(
+                    es, self._actions(documents, index),
+                    thread_count=n_workers, chunk_size=chunk_size,
+                    raise_on_error=False, raise_on_exception=False)
             else:
-                doc_without_id['publishTime'] = None
-            
-            # save the doc
-            self.mapping(meta={'id': doc['id']}, **doc_without_id).save()
+                results = streaming_bulk(
+                    es, self._actions(documents, index),
+                    chunk_size=chunk_size, raise_on_error=False,
+                    raise_on_exception=False)
+            # Results come back in document order
+            for i, (ok, info) in enumerate(results):
+                if ok:
+                    n_ok += 1
+                else:
+                    n_failed += 1
+                    chunk_errors.append(info)
+                if (i + 1) % chunk_size == 0:
+                    self._report_chunk(i // chunk_size, chunk_errors)
+                    chunk_errors = []
+            if chunk_errors:
+                self._report_chunk((n_ok + n_failed) // chunk_size,
+                                   chunk_errors)
+        finally:
+            if restore is not None:
+                es.indices.put_settings(index=index,
+                                        body={'index': restore})
+            # refresh index to make changes live
+            es.indices.refresh(index=index)
+        elapsed = time() - t0
+        logging.info(f'Indexed {n_ok} documents ({n_failed} failed) in '
+                     f'{elapsed:.1f}s ({n_ok / max(elapsed, 1e-9):.0f}/s)')
+        return n_ok, n_failed
+
+    @classmethod
+    def _report_chunk(cls, chunk_i, errors):
+        if errors:
+            logging.error(f'Chunk {chunk_i}: {len(errors)} documents '
+                          f'failed, e.g. {errors[0]}')
 
-        # refresh index to make changes live
-        self.mapping._index.refresh()
+    def get_ids(self, batch_size=10000):
+        '''Set of the ids of all indexed documents, scrolled through
+        without fetching their source'''
+        s = self.mapping.search().source(False).params(size=batch_size)
+        return set(hit.meta.id for hit in s.scan())
 
-    def _search(self, query, n, target_fields=['body', 'abstract'],
-                frag_size=500, n_frags=3):
+    def reset(self):
+        '''Delete all documents by recreating the index'''
+        self.mapping._index.delete(ignore=404)
+        self.mapping.init()
+
+    def _rebuild(self, documents, **kwargs):
+        '''Index documents into a new index, then atomically point the
+        mapping's index name (an alias) at it and drop the old index'''
+        es = connections.get_connection()
+        alias = self.mapping._index._name
+        new_index = f'{alias}_{int(time())}'
+        self.mapping._index.clone(name=new_index).create()
+        n_ok, n_failed = self._add(documents, index=new_index, **kwargs)
+        if not n_ok:
+            logging.error(f'No documents could be indexed into {new_index} '
+                          f'- keeping {alias} as it is')
+            es.indices.delete(index=new_index, ignore=404)
+            return n_ok, n_failed
+        old_indexes = []
+        actions = []
+        if es.indices.exists_alias(name=alias):
+            old_indexes = list(es.indices.get_alias(name=alias))
+            actions = [{'remove': {'index': i, 'alias': alias}}
+                       for i in old_indexes]
+        elif es.indices.exists(index=alias):
+            # A plain index of that name from before the first rebuild
+            actions = [{'remove_index': {'index': alias}}]
+        actions.append({'add': {'index': new_index, 'alias': alias}})
+        es.indices.update_aliases(body={'actions': actions})
+        for i in old_indexes:
+            es.indices.delete(index=i, ignore=404)
+        logging.info(f'{alias} now points at {new_index}')
+        return n_ok, n_failed
+
+    def _query_search(self, query, target_fields, timeout, ids=None):
+        '''Search object matching query against target_fields, best first'''
         # target_fields is in order of importance!!
         s = self.mapping.search()
-        s.query = MultiMatch(
+        if timeout is not None:
+            s = s.params(request_timeout=timeout)
+        q = MultiMatch(
             query=query,
             fields=target_fields,
         )
-        for f in target_fields:
-            s = s.highlight(f, pre_tags='', post_tags='',
-                            fragment_size=frag_size,
-                            number_of_fragments=n_frags)
-        s = s.sort(
+        if ids is not None:
+            q = Bool(should=[q], filter=[Ids(values=ids)])
+        s.query = q
+        return s.sort(
             {'_score': {'order': 'desc'}},
             {'publishTime': {'order': 'desc'}},
         )
+
+    def _search(self, query, n, target_fields=['body', 'abstract'],
+                frag_size=500, n_frags=3, timeout=None, ids=None):
+        '''Search for query. With ids, exactly those documents are
+        returned (even if they do not match) with their highlights.'''
+        s = self._query_search(query, target_fields, timeout, ids=ids)
+        # Documents without matches get their leading text as fragment
+        no_match = {'no_match_size': frag_size} if ids is not None else {}
+        for f in target_fields:
+            s = s.highlight(f, pre_tags='', post_tags='',
+                            fragment_size=frag_size,
+                            number_of_fragments=n_frags, **no_match)
         return s[:n].execute()
 
+    def rank_ids(self, query, n, target_fields=['body', 'abstract'],
+                 timeout=None, **kwargs):
+        '''Ids of the n best documents for query, without their source or
+        highlights (highlighting arguments are ignored)'''
+        s = self._query_search(query, target_fields, timeout).source(False)
+        return [hit.meta.id for hit in s[:n].execute()]
+
+    def _serialize_hits(self, results):
+        # Raw hits do not hold on to the response or connection
+        return [self._raw_hit(h) for h in results]
+
+    @classmethod
+    def _raw_hit(cls, hit):
+        '''Hit as returned by Elasticsearch, which Hit() turns back into
+        the same hit'''
+        raw = {'_source': hit.to_dict()}
+        for k, v in hit.meta.to_dict().items():
+            raw[k if k in ('highlight', 'sort') else f'_{k}'] = v
+        return raw
+
+    def _deserialize_hits(self, data):
+        return [Hit(h) for h in data]
+
     @classmethod
     def get_highlight_frags(cls, doc, fields=['body', 'abstract']):
         '''Extract highlighted fragments'''
@@ -2,10 +2,14 @@
 import logging
 from datetime import datetime
 import json
+import threading
 
 import openai
 
 from base.config_loader import ConfigLoader
+from deadline import call_with_timeout
+from metrics import metrics
+from fast_classifier import FastClassifier
 from question_type import QuestionType
 from intent_type import IntentType
 
@@ -15,6 +19,14 @@ class GPT3Adapter(ConfigLoader):
         super().__init__()
         openai.api_key = self.api_key
         self._load_prompts()
+        # Request threads append to the same label log
+        self.label_log_lock = threading.Lock()
+        self.fast_classifier = None
+        if self.fast_classifier_config.get('enabled', False):
+            self.fast_classifier = FastClassifier(
+                model_file=self.fast_classifier_config['model_file'],
+                threshold=self.fast_classifier_config['threshold'],
+                graph_hashtags=self.graph_hashtags)
 
     def _load_prompts(self):
         '''Read prompt from text files specified in config'''
@@ -50,70 +62,135 @@ class GPT3Adapter(ConfigLoader):
         answer = answer.capitalize()
         return answer
 
-    def query(self, prompt, max_retries=10, retry_wait=3, **kwargs):
+    def query(self, prompt, max_retries=10, retry_wait=3, deadline=None,
+              **kwargs):
         '''
         Query GPT3 to generate text based on a prompt.
         Parameter documentation:
         https://beta.openai.com/docs/api-reference/create-completion
+        With a deadline, each attempt may only take the remaining budget
+        and TimeoutError is raised once the budget is spent.
         '''
         for i in range(max_retries):
+            if deadline is not None and deadline.expired():
+                raise TimeoutError(
+                    f'GPT3 deadline expired after {i} attempts')
+            metrics.inc('gpt3_calls')
             try:
-                return openai.Completion.create(
+                # The client has no per-request timeout of its own
+                return call_with_timeout(
+                    None if deadline is None else deadline.timeout(),
+                    openai.Completion.create,
                     engine=self.engine,
                     prompt=prompt,
                     **kwargs)['choices'][0]['text'].strip()
             except Exception as e:
+                metrics.inc('gpt3_errors')
+                if deadline is not None and deadline.expired():
+                    raise TimeoutError(
+                        f'GPT3 deadline expired during attempt {i+1}: {e}')
                 if i == max_retries - 1:
                     raise(e)
                 logging.error(f'Exception occured during GPT3: {e}')
                 logging.warning(
                     f'Retrying ({i+1}/{max_retries}) in {retry_wait}s')
 
-    def get_intent(self, msg):
+    def _query_or_degrade(self, stage, fallback, prompt, deadline=None,
+                          **kwargs):
+        '''Query GPT3, or record the degradation and return fallback if
+        the deadline runs out first'''
+        try:
+            return self.query(prompt, deadline=deadline, **kwargs)
+        except TimeoutError as e:
+            # Without a deadline this is a network timeout, not running
+            # out of time budget
+            if deadline is None:
+                raise
+            logging.error(f'GPT3 {stage} gave up: {e}')
+            deadline.degrade(f'gpt3_{stage}')
+            return fallback
+
+    def _log_label(self, task, msg, label):
+        '''Record GPT-3 decisions as training data for the fast classifier'''
+        line = json.dumps({'task': task, 'msg': msg, 'label': label})
+        with self.label_log_lock:
+            with open('logs/classifications.jsonl', 'a') as f:
+                f.write(line + '\n')
+
+    def get_intent(self, msg, deadline=None):
         '''Determine message intent'''
+        if self.fast_classifier is not None:
+            intent = self.fast_classifier.predict_intent(msg)
+            if intent is not None:
+                return intent
         prompt = self._prepare_prompt('sentence_intent_prompt', msg)
-        intent = self.query(prompt, **self.sentence_intent_params).lower()
-        return {
+        # Without time for GPT3, assume the most common intent
+        intent = self._query_or_degrade(
+            'intent', None, prompt, deadline=deadline,
+            **self.sentence_intent_params)
+        if intent is None:
+            return IntentType.Question
+        intent = {
             'q': IntentType.Question,
             'u': IntentType.AboutMe,
             'o': IntentType.Over,
-        }.get(intent, IntentType.Confused)
+        }.get(intent.lower(), IntentType.Confused)
+        self._log_label('intent', msg, intent.name)
+        return intent
 
-    def answer_question_about_me(self, msg):
+    def answer_question_about_me(self, msg, deadline=None):
         '''Answer personal question'''
         prompt = self._prepare_prompt('about_self_prompt', msg)
-        answer = self.query(prompt, **self.about_self_params)
+        answer = self._query_or_degrade(
+            'about_self', self.dangerous_answer_replacement, prompt,
+            deadline=deadline, **self.about_self_params)
         return self._postprocess_answer(answer)
 
-    def autocorrect(self, msg):
+    def autocorrect(self, msg, deadline=None):
         '''Autocorrect English message'''
         while msg.endswith('\n'):
             msg = msg[:-1]
         prompt = self._prepare_prompt('autocorrect_prompt', msg)
-        answer = self.query(prompt, **self.autocorrect_params)
+        answer = self._query_or_degrade(
+            'autocorrect', msg, prompt, deadline=deadline,
+            **self.autocorrect_params)
         return self._postprocess_answer(answer)
 
-    def classify_question(self, question):
+    def classify_question(self, question, deadline=None):
         '''Classify question into either stats or text search question'''
-        if any(ht in question.lower() for ht in self.graph_hashtags):
+        if self.fast_classifier is not None:
+            qtype = self.fast_classifier.predict_question_type(question)
+            if qtype is not None:
+                return qtype
+        elif any(ht in question.lower() for ht in self.graph_hashtags):
             return QuestionType.Stats
         prompt = self._prepare_prompt(
             'classify_question_prompt', question)
-        qtype = self.query(prompt, **self.classify_question_params).lower()
-        return QuestionType.Stats if 'stats' in qtype else QuestionType.Textual
+        qtype = self._query_or_degrade(
+            'classify_question', None, prompt, deadline=deadline,
+            **self.classify_question_params)
+        if qtype is None:
+            return QuestionType.Textual
+        qtype = QuestionType.Stats if 'stats' in qtype.lower() \
+            else QuestionType.Textual
+        self._log_label('question_type', question, qtype.name)
+        return qtype
 
-    def parse_numerical_query(self, query):
+    def parse_numerical_query(self, query, deadline=None):
         '''
         Parse natural language into structured location, metric type,
         from and to dates.
         '''
         prompt = self._prepare_prompt(
             'parse_numbers_prompt', query)
-        spec = self.query(prompt, **self.parse_numbers_params)
+        # None when out of time
+        spec = self._query_or_degrade(
+            'parse_numbers', None, prompt, deadline=deadline,
+            **self.parse_numbers_params)
         logging.info(f'Numerical Query Spec: {spec}')
         return spec
 
-    def extract_answer(self, question, i_excerpts):
+    def extract_answer(self, question, i_excerpts, deadline=None):
         '''
         Produce an explanation to user's textual inquiry using excerpts.
         '''
@@ -122,7 +199,10 @@ class GPT3Adapter(ConfigLoader):
         prompt = self._prepare_prompt(
             'extract_answer_prompt', question, excerpts=excerpts_text)
         logging.info(f'Answer extraction prompt is {len(prompt)} chars')
-        answer = self.query(prompt, **self.extract_answer_params)
+        # The fallback makes the reply point to the sources instead
+        answer = self._query_or_degrade(
+            'extract_answer', 'I\'m not sure.', prompt, deadline=deadline,
+            **self.extract_answer_params)
         # Save prompt for post mortem
         words = [w.capitalize() for w in question.split(' ')]
         filename = datetime.now().strftime(r'%Y%m%d-%H%M%S_') + \
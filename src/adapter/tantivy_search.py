@@ -1,43 +1,215 @@
 # Search indexing adaptor using tantivy
 # Source: https://github.com/tantivy-search/tantivy-py
+import logging
 import os
+import re
+import threading
+from datetime import datetime
+from time import sleep, time
+from types import SimpleNamespace
 
 import tantivy
 
-from base.search_engine import SearchEngineBase
+from .base.search_engine import SearchEngineBase
+
+# (name, stored) of the text fields of each kind of index. publishTime is
+# always added as a date field; id is indexed untokenized.
+default_article_fields = [
+    ('id', True),
+    ('title', True),
+    ('authors', True),
+    ('abstract', True),
+    ('body', True),
+    ('url', True),
+]
+aux_passage_fields = [
+    ('id', True),
+    ('title', True),
+    ('url', True),
+    ('body', True),
+]
+
+
+class TantivyHit(dict):
+    '''Search hit exposing the same fields as an Elasticsearch hit'''
+
+    def __init__(self, fields, score, highlight):
+        super().__init__(fields)
+        # No index name: references to these docs cannot be resolved by
+        # the excerpt server's document store
+        self.meta = SimpleNamespace(id=fields.get('id'), index=None,
+                                    score=score, highlight=highlight)
 
 
 class TantivyAdapter(SearchEngineBase):
+    '''
+    In-process search engine. A single writer is kept open and commits
+    every commit_every documents (and at the end of each add); a single
+    searcher is shared by all queries and swapped for a fresh one every
+    reload_interval seconds.
+    '''
+
     def __init__(self,
-                 index_path='tantivy_index',
-                 fields=[
-                     ('id', True),
-                     ('title', True),
-                     ('authors', True),
-                     ('publishTime', True),
-                     ('abstract', True),
-                     ('body', True)]
-                 ):
+                 index_path='data/tantivy_index',
+                 fields=default_article_fields,
+                 commit_every=10000,
+                 writer_heap_size=256 * 1024 * 1024,
+                 reload_interval=5.0,
+                 cache_size=0,
+                 cache_ttl=None,
+                 cache_max_bytes=None,
+                 generation_file=None):
+        super().__init__(cache_size=cache_size, cache_ttl=cache_ttl,
+                         cache_max_bytes=cache_max_bytes,
+                         generation_file=generation_file)
         schema_builder = tantivy.SchemaBuilder()
         for field, stored in fields:
-            schema_builder.add_text_field(field, stored=stored)
+            schema_builder.add_text_field(
+                field, stored=stored,
+                tokenizer_name='raw' if field == 'id' else 'default')
+        schema_builder.add_date_field('publishTime', stored=True,
+                                      indexed=True, fast=True)
         self.schema = schema_builder.build()
-        if not os.path.exists(index_path):
-            os.mkdir(index_path)
+        self.text_fields = [field for field, _ in fields]
+        os.makedirs(index_path, exist_ok=True)
         self.index = tantivy.Index(self.schema, index_path)
+        self.commit_every = int(commit_every)
+        self.writer_heap_size = int(writer_heap_size)
+        self.writer = None
+        self.writer_lock = threading.Lock()
+        self.searcher = self.index.searcher()
+        self.reload_interval = float(reload_interval)
+        if self.reload_interval > 0:
+            threading.Thread(target=self._reload_forever, daemon=True,
+                             name='tantivy-reloader').start()
+
+    def _reload_forever(self):
+        while True:
+            sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception as e:
+                logging.error(f'Could not reload tantivy index due to {e}')
+
+    def reload(self):
+        '''Point the shared searcher at the last commit'''
+        self.index.reload()
+        self.searcher = self.index.searcher()
 
-    def _add(self, documents):
-        writer = self.index.writer()
+    def _get_writer(self):
+        if self.writer is None:
+            self.writer = self.index.writer(self.writer_heap_size)
+        return self.writer
+
+    def _to_document(self, doc):
+        document = tantivy.Document()
+        for field in self.text_fields:
+            value = doc.get(field)
+            if value:
+                document.add_text(field, str(value))
+        if doc.get('publishTime'):
+            document.add_date('publishTime',
+                              datetime.fromisoformat(doc['publishTime']))
+        return document
+
+    def _add(self, documents, **kwargs):
         if isinstance(documents, dict):
             documents = [documents]
-        for doc in documents:
-            writer.add_document(tantivy.Document(**doc))
-        writer.commit()
+        t0 = time()
+        n_docs = 0
+        with self.writer_lock:
+            writer = self._get_writer()
+            for doc in documents:
+                writer.add_document(self._to_document(doc))
+                n_docs += 1
+                if n_docs % self.commit_every == 0:
+                    writer.commit()
+                    logging.info(f'Committed {n_docs} documents')
+            writer.commit()
+        self.reload()
+        logging.info(f'Indexed {n_docs} documents in {time()-t0:.1f}s')
+        return n_docs, 0
 
-    def _search(self, query, n=3, target_fields=['title', 'abstract', 'body']):
-        # Reload the index to ensure it points to the last commit.
-        self.index.reload()
-        searcher = self.index.searcher()
-        query = self.index.parse_query(query, target_fields)
-        search_result = searcher.search(query, limit=n)
-        return [searcher.doc(doc_addr) for _, doc_addr in search_result.hits]
+    def get_ids(self):
+        '''Set of the ids of all indexed documents, read from the term
+        dictionary of the id field without loading stored documents'''
+        return set(term for term, _ in
+                   self.searcher.terms_with_prefix('id', ''))
+
+    def reset(self):
+        '''Delete all documents'''
+        with self.writer_lock:
+            writer = self._get_writer()
+            writer.delete_all_documents()
+            writer.commit()
+
+    def _rebuild(self, documents, **kwargs):
+        '''Delete all documents and add the new ones in a single commit'''
+        t0 = time()
+        with self.writer_lock:
+            writer = self._get_writer()
+            writer.delete_all_documents()
+            for doc in documents:
+                writer.add_document(self._to_document(doc))
+            writer.commit()
+        self.reload()
+        logging.info(f'Rebuilt index with {len(documents)} documents in '
+                     f'{time()-t0:.1f}s')
+        return len(documents), 0
+        self.reload()
+
+    def _search(self, query, n=3, target_fields=['body', 'abstract'],
+                frag_size=500, n_frags=3, timeout=None):
+        searcher = self.searcher
+        target_fields = [f for f in target_fields if f in self.text_fields]
+        # Questions are plain words like in Elasticsearch's multi_match:
+        # drop query syntax (field:, -, quotes, AND/OR/NOT) before parsing
+        words = re.sub(r'[^\w\s]', ' ', query).lower()
+        try:
+            parsed, errors = self.index.parse_query_lenient(words,
+                                                            target_fields)
+        except ValueError as e:
+            logging.warning(f'Could not parse query {query!r} due to {e}')
+            return []
+        if errors:
+            logging.debug(f'Ignored parts of query {query!r}: {errors}')
+        # Fetch extra hits so that ties at the cut-off can be broken by
+        # recency like Elasticsearch's secondary sort
+        hits = searcher.search(parsed, limit=2 * n).hits
+        if len(hits) > n:
+            cutoff = hits[n - 1][0]
+            hits = [(s, a) for s, a in hits if s >= cutoff]
+        docs = [(score, searcher.doc(addr)) for score, addr in hits]
+        docs.sort(key=lambda sd: (sd[0], self._publish_time(sd[1])),
+                  reverse=True)
+        snippet_gens = {}
+        for field in target_fields:
+            gen = tantivy.SnippetGenerator.create(
+                searcher, parsed, self.schema, field)
+            # One snippet covers what Elasticsearch splits into n_frags
+            gen.set_max_num_chars(frag_size * n_frags)
+            snippet_gens[field] = gen
+        results = []
+        for score, doc in docs[:n]:
+            highlight = {}
+            for field, gen in snippet_gens.items():
+                fragment = gen.snippet_from_doc(doc).fragment()
+                if fragment:
+                    highlight[field] = [fragment]
+            fields = {k: v[0] for k, v in doc.to_dict().items() if v}
+            if 'publishTime' in fields:
+                fields['publishTime'] = fields['publishTime'].isoformat()
+            results.append(TantivyHit(fields, score, highlight))
+        return results
+
+    @classmethod
+    def _publish_time(cls, doc):
+        values = doc.to_dict().get('publishTime')
+        return values[0].timestamp() if values else 0
+
+    @classmethod
+    def get_highlight_frags(cls, doc, fields=['body', 'abstract']):
+        '''Extract highlighted fragments'''
+        for field in fields:
+            if field in doc.meta.highlight:
+                return '\n\n'.join(doc.meta.highlight[field])
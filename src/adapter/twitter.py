@@ -56,7 +56,6 @@ class TwitterAdapter(MessagingAdapter):
         self.handle = '@' + self.me.screen_name
         self.message_handler = message_handler
         self.error_handler = error_handler
-        self.latest_tweet_id = None
         self.tweet_max_chars = 279
         self._load_public_suffix_list()
         self.url_extractor = URLExtract()
@@ -74,13 +73,13 @@ class TwitterAdapter(MessagingAdapter):
     def _data_handler(self, data):
         # Preprocess message
         tweet = data['text'].replace(self.handle + ' ', '').strip()
-        # Note down latest thread id
-        self.latest_tweet_id = data['id']
         if self.message_handler is None:
             logging.warning('No data handler defined!')
             logging.warning(json.dumps(data, indent=4, default=str))
         else:
-            self.message_handler(tweet)
+            # Pass the tweet id along with the message so that concurrent
+            # handlers each reply to their own tweet
+            self.message_handler(tweet, reply_to_id=data['id'])
 
     def _error_handler(self, status_code):
         if self.error_handler is None:
@@ -142,8 +141,6 @@ class TwitterAdapter(MessagingAdapter):
         return parts
 
     def _reply(self, msg, reply_to_id=None, media_ids=[]):
-        if reply_to_id is None:
-            reply_to_id = self.latest_tweet_id
         for i, part in enumerate(self._split_tweet(msg)):
             logging.info(f'Send tweet: \"{part}\"')
             part_media_ids = media_ids
@@ -5,8 +5,10 @@ import logging
 import urllib.parse as urlparse
 
 from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
 from base.config_loader import ConfigLoader
+from short_link_cache import ShortLinkCache
 
 
 class WebAdapter(ConfigLoader):
@@ -19,6 +21,27 @@ class WebAdapter(ConfigLoader):
         'Accept': 'application/json',
     }
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.short_link_cache = ShortLinkCache(self.short_link_cache_file)
+        # Keep connections to the shortening service alive across requests
+        self.shortener_session = requests.Session()
+        self.shortener_session.mount('https://', HTTPAdapter(
+            pool_connections=1, pool_maxsize=self.shortener_pool_size))
+
+    @classmethod
+    def pick_url(cls, url_field, banned_url_words):
+        '''Pick the first usable URL from a ;-separated URL field'''
+        try:
+            # Need to remove api links because they fail to
+            # actually lead to the paper
+            return next(
+                u for u in url_field.split(';')
+                if all(w not in u.lower() for w in banned_url_words)
+            )
+        except StopIteration:
+            return url_field
+
     @classmethod
     def _clean_text(cls, data):
         '''Remove parts of text that might hinder language processing'''
@@ -32,9 +55,9 @@ class WebAdapter(ConfigLoader):
         data = re.sub(r' +', ' ', data)
         return data
 
-    def parse_page(self, url, page_type='generic'):
+    def parse_page(self, url, page_type='generic', timeout=None):
         '''Download HTML and extract text from webpage'''
-        html_data = requests.get(url).text
+        html_data = requests.get(url, timeout=timeout).text
         soup = BeautifulSoup(html_data, 'lxml')
         generic_tags = self.custom_parse.get('generic', [])
         if page_type not in self.custom_parse:
@@ -54,10 +77,22 @@ class WebAdapter(ConfigLoader):
 
     def get_excerpts(self, question, docs, timeout=50):
         '''Query excerpt extraction server to reduce documents into excerpts'''
+        return self._post_excerpts(self.excerpts_conn_str,
+                                   {'question': question, 'docs': docs},
+                                   timeout)
+
+    def get_excerpts_from_refs(self, question, refs, timeout=50):
+        '''Same as get_excerpts but documents are referred to by index, id
+        and offsets, letting the server look their text up itself'''
+        return self._post_excerpts(self.excerpts_refs_conn_str,
+                                   {'question': question, 'refs': refs},
+                                   timeout)
+
+    def _post_excerpts(self, conn_str, payload, timeout):
         r = requests.post(
-            self.excerpts_conn_str,
+            conn_str,
             headers=self.headers,
-            json={'question': question, 'docs': docs},
+            json=payload,
             timeout=timeout
         )
         if r.status_code == 200:
@@ -66,20 +101,30 @@ class WebAdapter(ConfigLoader):
             logging.error('Excerpts extraction server returned code'
                           f' {r.status_code}!')
             logging.error(r.content)
-            return r.content
+            # e.g. 503 while the server is still loading its model
+            r.raise_for_status()
+
+    def get_cached_short_urls(self, urls):
+        '''Return {url: short_url} for URLs that were shortened before'''
+        return self.short_link_cache.get_many(urls)
 
-    def shorten_url(self, url):
+    def shorten_url(self, url, timeout=None):
         '''Make long URL shorter using cuttly'''
         if not url:
             logging.warning('Tried to shorten empty URL!')
             return url
+        short_url = self.short_link_cache.get(url)
+        if short_url is not None:
+            return short_url
         api_key = self.cuttly_config["api_key"]
         request_url = ('https://cutt.ly/api/api.php?'
                        f'key={api_key}'
                        f'&short={urlparse.quote(url)}')
-        r = requests.get(request_url)
+        r = self.shortener_session.get(request_url, timeout=timeout)
         if r.status_code == 200:
-            return json.loads(r.content)['url']['shortLink']
+            short_url = json.loads(r.content)['url']['shortLink']
+            self.short_link_cache.put(url, short_url)
+            return short_url
         else:
             logging.error('Cuttly server returned code'
                           f' {r.status_code}!')
@@ -0,0 +1,117 @@
+# Persistent cache of final answers keyed by normalized question
+import json
+import logging
+import os
+import re
+import shutil
+import sqlite3
+import threading
+from hashlib import sha1
+from time import time
+
+
+class AnswerCache:
+    '''
+    SQLite backed answer cache with TTL and size-bounded LRU eviction.
+    Entries remember the search index generation they were built from and
+    are dropped once the index has been updated since.
+    '''
+
+    def __init__(self,
+                 path='data/answer_cache.sqlite',
+                 max_entries=10000,
+                 ttl=24*60*60,
+                 chart_dir='data/answer_cache_charts'):
+        self.path = path
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.chart_dir = chart_dir
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        os.makedirs(chart_dir, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS answers ('
+            ' key TEXT PRIMARY KEY,'
+            ' answer TEXT,'
+            ' urls TEXT,'
+            ' png_filename TEXT,'
+            ' generation INTEGER,'
+            ' created REAL,'
+            ' accessed REAL)')
+        self.conn.execute(
+            'CREATE INDEX IF NOT EXISTS answers_accessed ON answers(accessed)')
+        self.conn.commit()
+
+    @classmethod
+    def normalize(cls, question):
+        '''Lowercase and strip punctuation/extra spaces'''
+        question = re.sub(r'[^a-z0-9 ]', ' ', question.lower())
+        return re.sub(r' +', ' ', question).strip()
+
+    @classmethod
+    def _key(cls, question, question_type):
+        return f'{question_type.name}:{cls.normalize(question)}'
+
+    def _delete(self, rows):
+        '''Delete entries given (key, png_filename) rows'''
+        for _, png_filename in rows:
+            if png_filename and os.path.exists(png_filename):
+                os.remove(png_filename)
+        self.conn.executemany('DELETE FROM answers WHERE key=?',
+                              [(key,) for key, _ in rows])
+
+    def get(self, question, question_type, generation):
+        '''Return (answer, urls, png_filename) or None on miss'''
+        key = self._key(question, question_type)
+        now = time()
+        with self.lock:
+            row = self.conn.execute(
+                'SELECT answer, urls, png_filename, generation, created '
+                'FROM answers WHERE key=?', (key,)).fetchone()
+            if row is None:
+                return None
+            answer, urls, png_filename, entry_generation, created = row
+            if entry_generation != generation or now - created > self.ttl:
+                logging.info(f'Dropping stale cached answer for "{key}"')
+                self._delete([(key, png_filename)])
+                self.conn.commit()
+                return None
+            self.conn.execute('UPDATE answers SET accessed=? WHERE key=?',
+                              (now, key))
+            self.conn.commit()
+        return answer, json.loads(urls), png_filename
+
+    def put(self, question, question_type, generation,
+            answer, urls, png_filename=None):
+        '''Store an answer, evicting least recently used entries'''
+        key = self._key(question, question_type)
+        # URLs must be JSON serializable
+        urls = [u for u in urls if isinstance(u, str)]
+        if png_filename is not None:
+            # The original graph file gets overwritten by later requests so
+            # keep a copy owned by the cache
+            cached_png = os.path.join(
+                self.chart_dir, sha1(key.encode('utf-8')).hexdigest() + '.png')
+            shutil.copyfile(png_filename, cached_png)
+            png_filename = cached_png
+        now = time()
+        with self.lock:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, answer, json.dumps(urls), png_filename, generation,
+                 now, now))
+            evicted = self.conn.execute(
+                'SELECT key, png_filename FROM answers '
+                'ORDER BY accessed DESC LIMIT -1 OFFSET ?',
+                (self.max_entries,)).fetchall()
+            self._delete(evicted)
+            self.conn.commit()
+
+    def clear(self):
+        '''Drop all entries'''
+        with self.lock:
+            rows = self.conn.execute(
+                'SELECT key, png_filename FROM answers').fetchall()
+            self._delete(rows)
+            self.conn.commit()
@@ -0,0 +1,66 @@
+# Thread-safe in-memory LRU cache with optional TTL and size bound
+import threading
+from collections import OrderedDict
+from time import time
+
+
+class LRUCache:
+    '''
+    Bounded mapping that evicts the least recently used entry when full
+    and treats entries older than ttl seconds (if set) as missing. With
+    max_bytes, the sizes given to put must also add up to at most
+    max_bytes. Keeps hit/miss counts for reporting.
+    '''
+
+    def __init__(self, max_entries=1024, ttl=None, max_bytes=None):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        # key -> (value, created, size)
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                value, created, _ = entry
+                if self.ttl is None or time() - created <= self.ttl:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return value
+                self._pop(key)
+            self.misses += 1
+            return default
+
+    def _pop(self, key):
+        self.n_bytes -= self.entries.pop(key)[2]
+
+    def put(self, key, value, size=0):
+        with self.lock:
+            if key in self.entries:
+                self._pop(key)
+            # Too big to ever fit
+            if self.max_bytes is not None and size > self.max_bytes:
+                return
+            self.entries[key] = (value, time(), size)
+            self.n_bytes += size
+            while len(self.entries) > self.max_entries or (
+                    self.max_bytes is not None
+                    and self.n_bytes > self.max_bytes):
+                self._pop(next(iter(self.entries)))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.n_bytes = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
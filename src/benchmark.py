@@ -0,0 +1,258 @@
+# Offline trace-replay benchmark for the whole Professor pipeline
+# Usage:
+#   python src/benchmark.py trace=<messages file> [key=value ...]
+# Each line of the trace file is either a plain message, a tweet JSON
+# object ({"text": ...}) or an answer log JSON object ({"question": ...}).
+# Remaining key=value pairs override the latencies below or any
+# professor.json setting (values are parsed as JSON when possible).
+import json
+import logging
+import os
+import sys
+from datetime import datetime, timedelta
+from time import sleep, time
+from types import SimpleNamespace
+
+import pandas as pd
+
+from adapter.base.messaging import MessagingAdapter
+from adapter.base.search_engine import SearchEngineBase
+from adapter.web import WebAdapter
+from intent_type import IntentType
+from metrics import metrics
+from numerical import Numerical
+from professor import Professor
+from question_type import QuestionType
+
+# Injected latencies in seconds
+default_latencies = {
+    'gpt3_latency': 0.4,
+    'search_latency': 0.1,
+    'page_latency': 0.5,
+    'excerpts_latency': 1.5,
+    'shorten_latency': 0.2,
+    'datalake_latency': 0.6,
+}
+
+
+class FakeMessaging(MessagingAdapter):
+    '''Stand-in for TwitterAdapter that only counts replies'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_replies = 0
+
+    def _reply(self, msg, reply_to_id=None, media_ids=[]):
+        self.n_replies += 1
+        return self.n_replies
+
+    def _upload_media(self, filename, **kwargs):
+        return SimpleNamespace(media_id=0)
+
+
+class FakeHit(dict):
+    '''Search hit exposing the same fields as an Elasticsearch hit'''
+
+    def __init__(self, doc_id, body, url):
+        super().__init__(id=doc_id, body=body, url=url)
+        self.meta = SimpleNamespace(id=doc_id, highlight={'body': [body]})
+
+
+class FakeSearchEngine(SearchEngineBase):
+    '''Stand-in for ElasticSearchAdapter returning synthetic hits'''
+
+    def __init__(self, latency):
+        self.latency = latency
+
+    def generation(self):
+        return 0
+
+    def _search(self, query, n, n_frags=3, frag_size=500, **kwargs):
+        sleep(self.latency)
+        frag = (f'Research on {query} is ongoing. ' * frag_size)[:frag_size]
+        return [FakeHit(f'paper{i}', '\n\n'.join([frag] * n_frags),
+                        f'https://example.org/paper{i}')
+                for i in range(n)]
+
+    @classmethod
+    def get_highlight_frags(cls, doc, fields=['body', 'abstract']):
+        for field in fields:
+            if field in doc.meta.highlight:
+                return '\n\n'.join(doc.meta.highlight[field])
+
+
+class FakeLanguage:
+    '''Stand-in for GPT3Adapter with a fixed latency per completion'''
+
+    def __init__(self, latency, graph_hashtags=('#graph', '#plot')):
+        self.latency = latency
+        self.graph_hashtags = graph_hashtags
+
+    def _complete(self):
+        metrics.inc('gpt3_calls')
+        sleep(self.latency)
+
+    def autocorrect(self, msg, deadline=None):
+        self._complete()
+        return msg.strip().capitalize()
+
+    def get_intent(self, msg, deadline=None):
+        self._complete()
+        return IntentType.AboutMe if ' you ' in f' {msg.lower()} ' \
+            else IntentType.Question
+
+    def classify_question(self, question, deadline=None):
+        if any(ht in question.lower() for ht in self.graph_hashtags):
+            return QuestionType.Stats
+        self._complete()
+        return QuestionType.Textual
+
+    def answer_question_about_me(self, msg, deadline=None):
+        self._complete()
+        return 'I am a bot that reads COVID-19 research.'
+
+    def parse_numerical_query(self, query, deadline=None):
+        self._complete()
+        return '{type: "case", location: "UnitedStates", from: "1m"}'
+
+    def extract_answer(self, question, i_excerpts, deadline=None):
+        self._complete()
+        return f'Based on {len(i_excerpts)} excerpts, it depends.'
+
+
+class FakeWeb(WebAdapter):
+    '''Stand-in for WebAdapter and the excerpt server'''
+
+    def __init__(self, page_latency, excerpts_latency, shorten_latency):
+        self.page_latency = page_latency
+        self.excerpts_latency = excerpts_latency
+        self.shorten_latency = shorten_latency
+        # In-memory stand-in for the short link cache
+        self.short_links = {}
+
+    def parse_page(self, url, page_type='generic', timeout=None):
+        sleep(self.page_latency)
+        return url, 'COVID-19 is a contagious disease. ' * 2000
+
+    def get_excerpts(self, question, docs, timeout=50):
+        sleep(self.excerpts_latency)
+        return [(i, doc[:200]) for i, doc in enumerate(docs)]
+
+    def get_cached_short_urls(self, urls):
+        return {u: self.short_links[u] for u in urls if u in self.short_links}
+
+    def shorten_url(self, url, timeout=None):
+        sleep(self.shorten_latency)
+        self.short_links[url] = f'https://cutt.ly/{abs(hash(url)) % 10**8}'
+        return self.short_links[url]
+
+
+class FakeNumerical(Numerical):
+    '''Numerical with the C3.ai data lake replaced by synthetic data'''
+
+    def __init__(self, language, latency):
+        self.gpt3 = language
+        self.latency = latency
+
+    def fetch_data(self, spec, deadline=None):
+        sleep(self.latency)
+        n_days = max((spec['to'] - spec['from']).days, 1)
+        dates = [spec['from'] + timedelta(days=i) for i in range(n_days)]
+        return pd.DataFrame({
+            'dates': dates,
+            'NYT_ConfirmedCases.data': [1000 + 10 * i for i in range(n_days)],
+            'NYT_ConfirmedCases.missing': [0] * n_days,
+        }), 'NYT'
+
+
+class BenchProfessor(Professor):
+    '''Professor wired to local stand-ins with injected latencies'''
+
+    def __init__(self, config_file, overrides):
+        self.overrides = overrides
+        self.latencies = {k: float(overrides.pop(k, v))
+                          for k, v in default_latencies.items()}
+        super().__init__(config_file=config_file)
+
+    def load_config(self, config_file):
+        super().load_config(config_file)
+        # Keep the benchmark self-contained unless asked otherwise
+        self.metrics_port = 0
+        self.answer_cache_size = 0
+        # There is no document store to resolve references against
+        self.excerpts_protocol = 'docs'
+        for k, v in self.overrides.items():
+            setattr(self, k, v)
+
+    def _init_components(self):
+        lat = self.latencies
+        self.messaging = FakeMessaging(message_handler=self.message_handler)
+        self.search_engine = FakeSearchEngine(lat['search_latency'])
+        self.aux_search_engine = FakeSearchEngine(lat['search_latency'])
+        # The data lake is only reached through Numerical.fetch_data
+        self.datalake = None
+        self.language = FakeLanguage(lat['gpt3_latency'])
+        self.web = FakeWeb(lat['page_latency'],
+                           lat['excerpts_latency'],
+                           lat['shorten_latency'])
+        self.numerical = FakeNumerical(self.language, lat['datalake_latency'])
+
+
+def load_trace(path):
+    '''Read messages from a trace file'''
+    messages = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                record = line
+            if isinstance(record, dict):
+                record = record.get('text', record.get('question', ''))
+            messages.append(str(record))
+    return messages
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def run(trace, config='config/professor.json', repeat=1, **overrides):
+    if not os.path.exists(config):
+        config = config + '.example'
+    messages = load_trace(trace) * int(repeat)
+    p = BenchProfessor(config, overrides)
+    logging.info(f'Replaying {len(messages)} messages with '
+                 f'{p.max_concurrent_requests} concurrent requests')
+    metrics.reset()
+
+    def replay(msg):
+        with metrics.span('generate_reply', log=False):
+            return p._generate_reply(msg)
+
+    t0 = time()
+    p.request_pool.map(replay, messages)
+    elapsed = time() - t0
+    print(f'{datetime.now():%Y-%m-%d %H:%M:%S} benchmark of {trace}')
+    print(f'Latencies: {p.latencies}')
+    print(f'{len(messages)} messages in {elapsed:.2f}s '
+          f'({len(messages)/elapsed:.2f} msg/s)')
+    print(metrics.format_table())
+    p.request_pool.close()
+    p.stage_pool.close()
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.WARNING,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    run(**{k: parse_value(v)
+           for k, v in (a.split('=', 1) for a in sys.argv[1:])})
@@ -1,18 +1,40 @@
 # Builds or updates research paper index
 import sys
 import os
+import re
 import json
 from time import time
 from glob import glob
 from itertools import chain
 import logging
 from datetime import datetime
+from multiprocessing.pool import ThreadPool
 
 from adapter.c3ai import C3aiAdapter
 from adapter.elastic_search import ElasticSearchAdapter as SearchEngine
+from adapter.elastic_search import AuxPassageMapping
 from adapter.web import WebAdapter
 
 
+def _search_engine(aux=False):
+    '''Search engine of the backend set in config/professor.json'''
+    with open('config/professor.json', 'r') as f:
+        backend = json.load(f).get('search_backend', 'elasticsearch')
+    if backend == 'tantivy':
+        from adapter.tantivy_search import TantivyAdapter
+        from adapter.tantivy_search import aux_passage_fields
+        if aux:
+            return TantivyAdapter(
+                index_path='data/tantivy_aux_index',
+                fields=aux_passage_fields,
+                generation_file='data/aux_index_generation')
+        return TantivyAdapter()
+    if aux:
+        return SearchEngine(mapping=AuxPassageMapping,
+                            generation_file='data/aux_index_generation')
+    return SearchEngine()
+
+
 def download(skip_to=-1, stop_at=-1, get_paper_args={}, output='file'):
     a = C3aiAdapter()
     for page_i, papers_page in enumerate(a.get_all_papers(**get_paper_args)):
@@ -75,24 +97,34 @@ def _get_doc_iters():
         yield _paper_to_doc(papers)
 
 
-def init_index():
-    t = SearchEngine()
+def init_index(chunk_size=500, n_workers=4):
+    t = _search_engine()
     doc_iter = chain.from_iterable(_get_doc_iters())
-    t.add(doc_iter)
+    t.add(doc_iter, chunk_size=chunk_size, n_workers=n_workers,
+          bulk_load=True)
 
 
 def update_index():
     a = C3aiAdapter()
-    t = SearchEngine()
+    t = _search_engine()
+    w = WebAdapter()
+    banned_url_words = _banned_url_words()
+    t0 = time()
+    indexed_ids = t.get_ids()
+    logging.info(f'{len(indexed_ids)} papers indexed '
+                 f'(listed in {time()-t0:.1f}s)')
     # Get (latest ids) - (indexed ids)
+    n_new = 0
     for i, ids_page in enumerate(a.get_all_biblioentry_ids()):
-        new_ids = []
-        for id_obj in ids_page:
-            paper_id = id_obj['id']
-            docs = t.search(paper_id, target_fields=['id'], n=1)
-            if docs and docs[0]['id'][0] == paper_id:
-                continue
-            new_ids.append(paper_id)
+        t0 = time()
+        page_ids = [id_obj['id'] for id_obj in ids_page]
+        new_ids = list(dict.fromkeys(
+            paper_id for paper_id in page_ids
+            if paper_id not in indexed_ids))
+        n_new += len(new_ids)
+        logging.info(f'IDs page {i}: {len(new_ids)}/{len(page_ids)} new '
+                     f'(diffed in {(time()-t0)*1000:.1f}ms, '
+                     f'{n_new} new so far)')
         if not new_ids:
             logging.info(f'IDs page {i} has no new paper IDs.')
             continue
@@ -101,20 +133,116 @@ def update_index():
         pages = download(get_paper_args={'filter': ' || '.join(f'id=="{i}"' for i in new_ids)},
                          output='yield')
         for papers in pages:
-            t.add(_paper_to_doc(papers))
+            docs = list(_paper_to_doc(papers))
+            t.add(docs)
+            indexed_ids.update(d['id'] for d in docs)
+            preshorten(docs, w, banned_url_words)
+    logging.info(f'{n_new} new papers in total')
+
+
+def embed_index(n_lists=0, batch_size=256):
+    '''Embed downloaded papers for the hybrid search backend'''
+    from adapter.dense_search import build_dense_index
+    with open('config/professor.json', 'r') as f:
+        config = json.load(f)
+    n_docs = 0
+    for path in sorted(glob('data/page_*.json')):
+        with open(path, 'r') as f:
+            n_docs += len(json.load(f))
+    build_dense_index(chain.from_iterable(_get_doc_iters()), n_docs,
+                      index_dir=config['dense_index_dir'],
+                      model_name=config['dense_model_name'],
+                      batch_size=int(batch_size),
+                      n_lists=int(n_lists))
+
+
+def _banned_url_words():
+    with open('config/professor.json', 'r') as f:
+        return json.load(f)['banned_url_words']
+
+
+def preshorten(docs, w, banned_url_words, n_threads=2):
+    '''Shorten paper URLs ahead of time so that replies hit the cache'''
+    urls = [w.pick_url(d['url'], banned_url_words)
+            for d in docs if d.get('url')]
+    known = w.get_cached_short_urls(urls)
+    new_urls = [u for u in dict.fromkeys(urls) if u not in known]
+    logging.info(f'Pre-shortening {len(new_urls)} URLs '
+                 f'({len(known)} already shortened)')
+
+    def shorten(url):
+        try:
+            w.shorten_url(url)
+        except Exception as e:
+            logging.error(f'Could not shorten URL "{url}" due to {e}')
+    with ThreadPool(int(n_threads)) as pool:
+        pool.map(shorten, new_urls)
+
+
+def preshorten_index(max_urls=-1, n_threads=2):
+    '''Pre-shorten URLs of downloaded papers (newest pages first)'''
+    max_urls = int(max_urls)
+    docs = []
+    # Pages are numbered in download order
+    paths = sorted(glob('data/page_*.json'), reverse=True,
+                   key=lambda p: int(re.search(r'page_(\d+)', p).group(1)))
+    for path in paths:
+        with open(path, 'r') as f:
+            docs.extend(_paper_to_doc(json.load(f)))
+        if max_urls != -1 and len(docs) >= max_urls:
+            docs = docs[:max_urls]
+            break
+    preshorten(docs, WebAdapter(), _banned_url_words(), n_threads=n_threads)
+
+
+def _split_passages(text, passage_len):
+    '''Split text into passages of about passage_len chars at sentence
+    boundaries'''
+    passages = []
+    while text:
+        cut = text.rfind('. ', 0, passage_len)
+        if cut == -1 or len(text) <= passage_len:
+            cut = passage_len
+        passages.append(text[:cut+1].strip())
+        text = text[cut+1:]
+    return [p for p in passages if p]
+
+
+def index_aux_pages():
+    '''(Re)build the auxiliary passage index from the configured reference
+    pages. Meant to run periodically, e.g. daily from cron.'''
+    w = WebAdapter()
+    docs = []
+    for page in w.aux_pages:
+        url = page['url']
+        title, text = w.parse_page(url, page_type=page['page_type'])
+        passages = _split_passages(text, w.aux_passage_len)
+        logging.info(f'{url} split into {len(passages)} passages')
+        now_str = datetime.now().strftime('%Y-%m-%dT%H:%M:%S')
+        docs.extend({
+            'id': f'{url}#{i}',
+            'title': title,
+            'url': url,
+            'publishTime': now_str,
+            'body': passage,
+        } for i, passage in enumerate(passages))
+    # Searches keep using the old passages until the new ones are in
+    t = _search_engine(aux=True)
+    n_ok, _ = t.rebuild(docs)
+    logging.info(f'Indexed {n_ok} auxiliary passages')
 
 
 def add(json_file):
     assert os.path.exists(json_file)
     with open(json_file, 'r') as f:
         page = json.load(f)
-    t = SearchEngine()
+    t = _search_engine()
     t.add(page)
 
 
 def add_web(url, page_type='generic'):
     # Download single page
-    t = SearchEngine()
+    t = _search_engine()
     w = WebAdapter()
     title, text = w.parse_page(url, page_type=page_type)
     print(text)
@@ -159,12 +287,18 @@ if __name__ == '__main__':
     if mode == 'download':
         list(download(**dict(v.split('=') for v in sys.argv[2:])))
     elif mode == 'init':
-        init_index()
+        init_index(**dict(v.split('=') for v in sys.argv[2:]))
     elif mode == 'update':
         update_index()
     elif mode == 'add':
         assert len(sys.argv) >= 3, 'Provide filename'
         add(sys.argv[2])
+    elif mode == 'aux':
+        index_aux_pages()
+    elif mode == 'embed':
+        embed_index(**dict(v.split('=') for v in sys.argv[2:]))
+    elif mode == 'shorten':
+        preshorten_index(**dict(v.split('=') for v in sys.argv[2:]))
     elif mode == 'addweb':
         assert len(sys.argv) >= 2, 'Provide URL'
         add_web(sys.argv[2], **dict(v.split('=') for v in sys.argv[3:]))
@@ -0,0 +1,72 @@
+# Per-request latency budget shared by every stage of the pipeline
+import logging
+import threading
+from time import time
+
+from metrics import metrics
+
+
+class Deadline:
+    '''
+    Tracks how much of a request's latency budget is left so that stages
+    can bound their timeouts and decide whether to degrade. Degradations
+    applied along the way are recorded on the deadline.
+    '''
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.expires_at = time() + budget
+        self.degradations = []
+
+    def remaining(self):
+        '''Seconds left in the budget (never negative)'''
+        return max(0.0, self.expires_at - time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def timeout(self, cap=None, floor=1.0):
+        '''
+        Timeout for a blocking call: the remaining budget, capped by the
+        call's own default and at least floor so calls never get 0s.
+        '''
+        timeout = self.remaining()
+        if cap is not None:
+            timeout = min(timeout, cap)
+        return max(timeout, floor)
+
+    def below(self, threshold):
+        '''Whether less than threshold seconds are left'''
+        return self.remaining() < threshold
+
+    def degrade(self, name):
+        '''Record that a stage was skipped or shrunk'''
+        logging.warning(f'Degrading "{name}" with {self.remaining():.1f}s '
+                        f'of {self.budget}s budget left')
+        metrics.inc(f'degraded_{name}')
+        self.degradations.append(name)
+
+
+def call_with_timeout(timeout, func, *args, **kwargs):
+    '''
+    Call func, waiting at most timeout seconds (forever with None) for it
+    to return. For clients without a per-call timeout: on TimeoutError the
+    call carries on in a daemon thread and its result is dropped.
+    '''
+    if timeout is None:
+        return func(*args, **kwargs)
+    outcome = {}
+
+    def run():
+        try:
+            outcome['result'] = func(*args, **kwargs)
+        except Exception as e:
+            outcome['error'] = e
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    if thread.is_alive():
+        raise TimeoutError(f'{func.__name__} took longer than {timeout:.1f}s')
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
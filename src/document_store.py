@@ -0,0 +1,76 @@
+# Resolves document references to text from the search index
+import logging
+from collections import defaultdict
+
+from elasticsearch_dsl import connections
+
+from base.lru_cache import LRUCache
+from metrics import metrics
+
+
+class DocumentStore:
+    '''
+    Looks up document fields by index and id in Elasticsearch, keeping
+    recently used fields in memory. A reference is a list of segments,
+    each either inline ({"text": ...}) or a character range of an indexed
+    document field ({"index", "id", "field", "start", "end"}); segments
+    are joined into one text the same way search fragments are.
+    '''
+    segment_sep = '\n\n'
+
+    def __init__(self, cache_size=4096, cache_max_bytes=None):
+        # Whole fields (e.g. paper bodies) vary a lot in size, so the
+        # entry count alone does not bound memory
+        self.cache = LRUCache(
+            max_entries=int(cache_size),
+            max_bytes=int(cache_max_bytes) if cache_max_bytes else None)
+
+    def _fetch(self, index, field, ids):
+        '''Bulk fetch one field of documents from an index'''
+        es = connections.get_connection()
+        response = es.mget(body={'ids': ids}, index=index,
+                           _source_includes=[field])
+        return {d['_id']: d['_source'].get(field) or ''
+                for d in response['docs'] if d.get('found')}
+
+    def get_fields(self, keys):
+        '''Return {(index, id, field): text} for all found keys'''
+        found = {}
+        missing = defaultdict(list)
+        for key in set(keys):
+            text = self.cache.get(key)
+            if text is None:
+                index, doc_id, field = key
+                missing[(index, field)].append(doc_id)
+            else:
+                found[key] = text
+        metrics.inc('document_store_hits', len(found))
+        for (index, field), ids in missing.items():
+            metrics.inc('document_store_misses', len(ids))
+            with metrics.span('document_store_fetch', log=False):
+                fetched = self._fetch(index, field, ids)
+            for doc_id, text in fetched.items():
+                key = (index, doc_id, field)
+                self.cache.put(key, text, size=len(text))
+                found[key] = text
+            if len(fetched) < len(ids):
+                logging.warning(f'{len(ids) - len(fetched)} of {len(ids)} '
+                                f'documents not found in {index}')
+        return found
+
+    def resolve(self, refs):
+        '''Turn references into document texts'''
+        keys = [(s['index'], s['id'], s['field'])
+                for ref in refs for s in ref if 'text' not in s]
+        fields = self.get_fields(keys)
+        docs = []
+        for ref in refs:
+            segments = []
+            for s in ref:
+                if 'text' in s:
+                    segments.append(s['text'])
+                else:
+                    text = fields.get((s['index'], s['id'], s['field']), '')
+                    segments.append(text[s['start']:s['end']])
+            docs.append(self.segment_sep.join(segments))
+        return docs
@@ -1,29 +1,115 @@
 import requests
 import re
 from time import time
-from multiprocessing.pool import ThreadPool
 import json
 import logging
+import os
+import shutil
 import subprocess
+import sys
+import threading
+from hashlib import sha1
 from time import sleep
 
+import numpy as np
 from bs4 import BeautifulSoup
 from adapter.elastic_search import ElasticSearchAdapter as SearchEngine
 from adapter.gpt3 import GPT3Adapter
+from answer_cache import AnswerCache
+from inference_queue import InferenceQueue
+from document_store import DocumentStore
+from base.lru_cache import LRUCache
+from metrics import metrics
 
 
-def get_model(model_name, use_gpu=False, pipieline_type='question-answering'):
+# Written last into a model cache directory, so that a directory without
+# it is known to be incomplete
+model_cache_marker = '.complete'
+
+
+def model_cache_path(cache_dir, model_name):
+    return os.path.join(cache_dir, model_name.replace('/', '--'))
+
+
+def _save_model_cache(model, local_dir):
+    '''Save weights and tokenizer into a temporary directory and rename
+    it into place once complete'''
+    tmp_dir = f'{local_dir}.tmp-{os.getpid()}'
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    model.model.save_pretrained(tmp_dir)
+    model.tokenizer.save_pretrained(tmp_dir)
+    open(os.path.join(tmp_dir, model_cache_marker), 'w').close()
+    if os.path.exists(os.path.join(local_dir, model_cache_marker)):
+        # Someone else finished first
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        return
+    # Leftover of an interrupted write
+    shutil.rmtree(local_dir, ignore_errors=True)
+    os.rename(tmp_dir, local_dir)
+
+
+def get_model(model_name, use_gpu=False, pipieline_type='question-answering',
+              quantize=False, intra_op_threads=None, cache_dir=None):
+    '''Load a pipeline for model_name. With cache_dir, weights are read
+    from (or on first use saved to) a local copy, including the int8
+    converted model when quantizing.'''
+    import torch
     from transformers import pipeline
+    if intra_op_threads:
+        torch.set_num_threads(int(intra_op_threads))
+        logging.info(f'Using {torch.get_num_threads()} intra-op threads')
     device = -1  # -1 for CPU
     if use_gpu:
         device = 0  # First GPU device
         logging.info(f'Using GPU device: {device}')
     else:
         logging.info('Using CPU')
-    logging.info(f'Initializing model "{model_name}"" ...')
-    model = pipeline(pipieline_type, model=model_name,
-                     tokenizer=model_name, framework='pt', device=device)
+    local_dir = None
+    source = model_name
+    if cache_dir:
+        local_dir = model_cache_path(cache_dir, model_name)
+        if os.path.exists(os.path.join(local_dir, model_cache_marker)):
+            source = local_dir
+    logging.info(f'Initializing model "{model_name}" from {source} ...')
+    # Fast tokenizers are needed for batched tokenization with offsets
+    model = pipeline(pipieline_type, model=source,
+                     tokenizer=source, framework='pt', device=device,
+                     use_fast=True)
     logging.info(f'Model max tokens: {model.tokenizer.model_max_length}')
+    if local_dir and source != local_dir:
+        logging.info(f'Saving model to {local_dir}')
+        _save_model_cache(model, local_dir)
+    if quantize:
+        int8_file = local_dir and os.path.join(local_dir, 'int8.pt')
+        if int8_file and os.path.exists(int8_file):
+            logging.info(f'Loading int8 model from {int8_file}')
+            model.model = torch.load(int8_file)
+        else:
+            quantize_model(model)
+            if int8_file:
+                tmp_file = f'{int8_file}.tmp-{os.getpid()}'
+                torch.save(model.model, tmp_file)
+                os.replace(tmp_file, int8_file)
+    return model
+
+
+def fill_model_cache(model_name, cache_dir, quantize=False):
+    '''Download (and quantize) model_name into cache_dir unless already
+    there'''
+    local_dir = model_cache_path(cache_dir, model_name)
+    int8_file = os.path.join(local_dir, 'int8.pt')
+    if os.path.exists(os.path.join(local_dir, model_cache_marker)) and \
+            (not quantize or os.path.exists(int8_file)):
+        return
+    get_model(model_name, quantize=quantize, cache_dir=cache_dir)
+
+
+def quantize_model(model):
+    '''Apply dynamic int8 quantization to the model's linear layers (CPU)'''
+    import torch
+    logging.info('Quantizing linear layers to int8')
+    model.model = torch.quantization.quantize_dynamic(
+        model.model, {torch.nn.Linear}, dtype=torch.qint8)
     return model
 
 
@@ -52,53 +138,217 @@ def get_web_data(url):
     return data
 
 
-def split_data(data, part_len):
-    base = 0
-    i = 0
-    parts = []
-    while True:
-        part = data[base:base+part_len]
-        last_period = part.rfind('.')
-        if last_period == -1:
-            last_period = part_len
-        part = part[:last_period+1].strip()
-        parts.append(part)
-        base = base + last_period+1
-        if base >= len(data):
-            break
-        i += 1
-    return parts
-
-
-def get_find_answer_func(model, question):
-    def find_answer(part):
-        return model({
-            'context': part,
-            'question': question,
-        })
-    return find_answer
-
-
-def get_excerpts_text(top_answers):
+def tokenize_context(tokenizer, text, cache=None):
+    '''Token ids and character offsets of a context, without special
+    tokens; cached by content hash when a cache is given'''
+    key = sha1(text.encode('utf-8')).hexdigest()
+    if cache is not None:
+        tokens = cache.get(key)
+        if tokens is not None:
+            return tokens
+    enc = tokenizer(text, add_special_tokens=False,
+                    return_offsets_mapping=True)
+    tokens = (np.array(enc['input_ids'], dtype=np.int32),
+              np.array(enc['offset_mapping'], dtype=np.int32).reshape(-1, 2))
+    if cache is not None:
+        cache.put(key, tokens)
+    return tokens
+
+
+def token_windows(n_tokens, window_len, doc_stride):
+    '''(start, end) token ranges covering n_tokens with windows of
+    window_len overlapping by doc_stride; the last window is shifted back
+    so that every window is full'''
+    if n_tokens <= window_len:
+        return [(0, n_tokens)]
+    step = max(window_len - doc_stride, 1)
+    starts = list(range(0, n_tokens - window_len, step))
+    starts.append(n_tokens - window_len)
+    return [(s, s + window_len) for s in starts]
+
+
+def _best_span(start_logits, end_logits, context_mask, max_answer_len):
+    '''Most probable (start, end, score) span within the context tokens,
+    scored like the question-answering pipeline'''
+    def masked_softmax(logits):
+        logits = np.where(context_mask, logits, -1e4)
+        e = np.exp(logits - logits.max())
+        return e / e.sum()
+    p_start = masked_softmax(start_logits)
+    p_end = masked_softmax(end_logits)
+    scores = np.triu(np.outer(p_start, p_end))
+    scores = np.tril(scores, max_answer_len - 1)
+    start, end = np.unravel_index(scores.argmax(), scores.shape)
+    return int(start), int(end), float(scores[start, end])
+
+
+def bm25_scores(windows, query_ids, k1=1.2, b=0.75):
+    '''BM25 score of each window (array of token ids) for the query,
+    treating the given windows as the whole collection'''
+    query_ids = np.unique(np.asarray(query_ids, dtype=np.int64))
+    lengths = np.array([len(w) for w in windows])
+    padded = np.full((len(windows), max(lengths.max(), 1)), -1,
+                     dtype=np.int64)
+    for i, w in enumerate(windows):
+        padded[i, :len(w)] = w
+    tf = (padded[:, :, None] == query_ids[None, None, :]).sum(axis=1)
+    df = (tf > 0).sum(axis=0)
+    idf = np.log(1 + (len(windows) - df + 0.5) / (df + 0.5))
+    norm = k1 * (1 - b + b * lengths / max(lengths.mean(), 1))
+    return (idf * tf * (k1 + 1) / (tf + norm[:, None])).sum(axis=1)
+
+
+def prefilter_windows(windows, questions, top_k):
+    '''Keep only the top_k windows of each (question, doc) pair by BM25
+    score, so that a pair's answer does not depend on the other pairs
+    batched with it'''
+    by_pair = {}
+    for w in windows:
+        by_pair.setdefault(w['pair_i'], []).append(w)
+    kept = []
+    for pair_windows in by_pair.values():
+        if len(pair_windows) > top_k:
+            question = pair_windows[0]['question']
+            scores = bm25_scores([w['ctx_ids'] for w in pair_windows],
+                                 questions[question][0])
+            top = np.argsort(-scores, kind='stable')[:top_k]
+            pair_windows = [pair_windows[i] for i in sorted(top)]
+        kept.extend(pair_windows)
+    metrics.inc('prefilter_windows', len(windows))
+    metrics.inc('prefilter_windows_kept', len(kept))
+    logging.info(f'Prefilter kept {len(kept)}/{len(windows)} windows')
+    return kept
+
+
+def find_answers(model, pairs, batch_size=16, max_seq_len=384,
+                 doc_stride=128, max_answer_len=30, token_cache=None,
+                 top_k=None):
+    '''
+    Find the best answer span for each (question, context) pair.
+    Contexts are tokenized once (reusing token_cache) and cut in token
+    space into full windows of max_seq_len tokens overlapping by
+    doc_stride. Contexts without any token get an empty answer. With
+    top_k, only the top_k windows of each pair by BM25 reach the model.
+    Windows are sorted by length and run through the model in padded
+    batches of batch_size windows per forward pass.
+    '''
+    import torch
+    if not pairs:
+        return []
+    tokenizer = model.tokenizer
+    questions = {}
+    windows = []
+    input_names = ['input_ids']
+    for pair_i, (question, context) in enumerate(pairs):
+        if question not in questions:
+            q_enc = tokenizer(question, add_special_tokens=False)
+            # Token type ids only for models whose tokenizer produces them
+            if 'token_type_ids' in q_enc:
+                input_names = ['input_ids', 'token_type_ids']
+            q_ids = q_enc['input_ids'][:max_seq_len // 2]
+            # Position of the context within the model input
+            ctx_start = tokenizer.build_inputs_with_special_tokens(
+                q_ids, [-1]).index(-1)
+            window_len = max_seq_len - len(q_ids) - \
+                tokenizer.num_special_tokens_to_add(pair=True)
+            questions[question] = (q_ids, ctx_start, window_len)
+        q_ids, ctx_start, window_len = questions[question]
+        ctx_ids, offsets = tokenize_context(tokenizer, context, token_cache)
+        # Empty contexts (e.g. unresolved references) have no span to find
+        if not len(ctx_ids):
+            continue
+        for start, end in token_windows(len(ctx_ids), window_len, doc_stride):
+            ids = ctx_ids[start:end].tolist()
+            windows.append({
+                'pair_i': pair_i,
+                'question': question,
+                'ctx_ids': ctx_ids[start:end],
+                'ctx_start': ctx_start,
+                'offsets': offsets[start:end],
+                'input_ids':
+                    tokenizer.build_inputs_with_special_tokens(q_ids, ids),
+                'token_type_ids':
+                    tokenizer.create_token_type_ids_from_sequences(q_ids, ids),
+            })
+    best = [{'score': 0.0, 'start': 0, 'end': 0, 'answer': ''}
+            for _ in pairs]
+    if top_k:
+        windows = prefilter_windows(windows, questions, int(top_k))
+    order = sorted(range(len(windows)),
+                   key=lambda i: len(windows[i]['input_ids']))
+    for b in range(0, len(order), batch_size):
+        batch_windows = [windows[i] for i in order[b:b+batch_size]]
+        batch = tokenizer.pad(
+            {n: [w[n] for w in batch_windows] for n in input_names},
+            return_attention_mask=True,
+            return_tensors='pt')
+        batch = {k: v.to(model.device) for k, v in batch.items()}
+        with torch.no_grad():
+            outputs = model.model(**batch)
+        start_logits = outputs[0].cpu().numpy()
+        end_logits = outputs[1].cpu().numpy()
+        for row, w in enumerate(batch_windows):
+            n_tokens = len(w['input_ids'])
+            ctx_start, ctx_end = w['ctx_start'], \
+                w['ctx_start'] + len(w['offsets'])
+            context_mask = np.zeros(n_tokens, dtype=bool)
+            context_mask[ctx_start:ctx_end] = True
+            start, end, score = _best_span(start_logits[row, :n_tokens],
+                                           end_logits[row, :n_tokens],
+                                           context_mask, max_answer_len)
+            pair_i = w['pair_i']
+            if score > best[pair_i]['score']:
+                context = pairs[pair_i][1]
+                char_start = int(w['offsets'][start - ctx_start][0])
+                char_end = int(w['offsets'][end - ctx_start][1])
+                best[pair_i] = {
+                    'score': score,
+                    'start': char_start,
+                    'end': char_end,
+                    'answer': context[char_start:char_end],
+                }
+    return best
+
+
+def sentence_bounds(text, cache=None):
+    '''Sorted offsets where sentences start and end in text; cached by
+    content hash when a cache is given'''
+    key = sha1(text.encode('utf-8')).hexdigest()
+    if cache is not None:
+        bounds = cache.get(key)
+        if bounds is not None:
+            return bounds
+    starts = np.array([m.end(0) for m in re.finditer(r'[^\.]\. ', text)],
+                      dtype=np.int64)
+    ends = np.array([m.end(0) for m in re.finditer(r'[^\.]\.', text)],
+                    dtype=np.int64)
+    if cache is not None:
+        cache.put(key, (starts, ends))
+    return starts, ends
+
+
+def get_excerpts_text(top_answers, sentences_before=1, sentences_after=1,
+                      cache=None):
+    '''Widen each answer to the sentences around it, found by binary
+    search over the doc's sentence boundaries'''
     excerpts = []
-    sentences_before = 1
-    sentences_after = 1
     for i, (ans, part) in top_answers:
-        # Go n sentences ahead
-        str_before = part[:ans['start']]
-        ends_before = [m.end(0) for m in re.finditer(r'[^\.]\. ', str_before)]
-        if ends_before:
-            begin = ends_before[-min(len(ends_before), (sentences_before+1))]
+        starts, ends = sentence_bounds(part, cache)
+        # Go n sentences back from the start of the answer's sentence
+        n_before = int(np.searchsorted(starts, ans['start'], side='right'))
+        if n_before:
+            begin = int(starts[max(n_before - (sentences_before+1), 0)])
         else:
             begin = ans['start']
-        str_after = part[ans['end']:]
-        if len(str_after) < 2:
-            end = ans['end'] + len(str_after)
+        # Go n sentences ahead from the end of the answer's sentence
+        if len(part) - ans['end'] < 2:
+            end = len(part)
         else:
             end = ans['end']
-            ends_after = [m.end(0) for m in re.finditer(r'[^\.]\.', str_after)]
-            if ends_after:
-                end += ends_after[min(len(ends_after) - 1, sentences_after)]
+            i_after = int(np.searchsorted(ends, ans['end'] + 2))
+            if i_after < len(ends):
+                end = int(ends[min(len(ends) - 1,
+                                   i_after + sentences_after)])
         ans_src = part[begin:end]
         excerpts.append((i, ans_src))
     return excerpts
@@ -107,15 +357,102 @@ def get_excerpts_text(top_answers):
 class ExcerptGen:
     def __init__(self,
                  model_name='deepset/bert-large-uncased-whole-word-masking-squad2',
-                 accelerator='cpu'):
-        self._and_start_elastic_server()
-        self.se = SearchEngine()
+                 accelerator='cpu',
+                 batch_size=16,
+                 intra_op_threads=None,
+                 batch_max_pairs=64,
+                 batch_max_wait=0.01,
+                 cache_size=4096,
+                 max_seq_len=384,
+                 doc_stride=128,
+                 token_cache_size=1024,
+                 document_cache_size=4096,
+                 document_cache_max_bytes=None,
+                 model_cache_dir=None,
+                 sentences_before=1,
+                 sentences_after=1,
+                 prefilter_top_k=None,
+                 background_load=False):
+        self.document_store = DocumentStore(
+            cache_size=document_cache_size,
+            cache_max_bytes=document_cache_max_bytes)
         self.accelerator = accelerator.lower()
+        self.model_name = model_name
+        self.intra_op_threads = intra_op_threads
+        self.model_cache_dir = model_cache_dir
+        self.batch_size = int(batch_size)
+        self.max_seq_len = int(max_seq_len)
+        self.doc_stride = int(doc_stride)
+        # Windows per doc kept by the BM25 prefilter (None for all)
+        self.prefilter_top_k = int(prefilter_top_k) \
+            if prefilter_top_k else None
+        # Best answer per (question, doc); bounded by entry count
+        self.answer_cache = LRUCache(max_entries=int(cache_size))
+        # Token ids and offsets per doc content, shared by all questions
+        self.token_cache = LRUCache(max_entries=int(token_cache_size))
+        # Sentence boundaries per doc content for widening answers
+        self.sentence_cache = LRUCache(max_entries=int(token_cache_size))
+        self.sentences_before = int(sentences_before)
+        self.sentences_after = int(sentences_after)
         self.gpt3 = GPT3Adapter()
+        self.se = None
         self.model = None
-        if self.accelerator != 'colab':
-            self.model = get_model(model_name=model_name,
-                                   use_gpu=self.accelerator == 'gpu')
+        # Coalesce parts of concurrent requests into shared model batches
+        self.inference_queue = None
+        if self.accelerator != 'colab' and int(batch_max_pairs) > 0:
+            self.inference_queue = InferenceQueue(
+                self._find_answers_now,
+                max_pairs=batch_max_pairs,
+                max_wait=batch_max_wait)
+        # Set once Elasticsearch is up and the model is loaded and warm
+        self.ready = threading.Event()
+        self.load_error = None
+        if background_load:
+            threading.Thread(target=self.load, daemon=True,
+                             name='model-loader').start()
+        else:
+            self.load()
+
+    def load(self):
+        '''Connect to Elasticsearch, load the model and run a warm-up
+        forward pass so that the first request is not slowed down'''
+        try:
+            with metrics.span('excerpt_gen_load'):
+                self._and_start_elastic_server()
+                self.se = SearchEngine()
+                if self.accelerator != 'colab':
+                    self.model = get_model(
+                        model_name=self.model_name,
+                        use_gpu=self.accelerator == 'gpu',
+                        quantize=self.accelerator == 'cpu-int8',
+                        intra_op_threads=self.intra_op_threads,
+                        cache_dir=self.model_cache_dir)
+                    find_answers(self.model,
+                                 [('What is this?', 'This is a warm-up.')],
+                                 max_seq_len=self.max_seq_len,
+                                 doc_stride=self.doc_stride)
+        except (Exception, SystemExit) as e:
+            self.load_error = e
+            logging.error(f'Failed to load excerpt generator due to {e!r}')
+            return
+        metrics.set('excerpt_gen_ready', 1)
+        logging.info('Excerpt generator is ready')
+        self.ready.set()
+
+    def _find_answers_now(self, pairs):
+        return find_answers(self.model, pairs,
+                            batch_size=self.batch_size,
+                            max_seq_len=self.max_seq_len,
+                            doc_stride=self.doc_stride,
+                            token_cache=self.token_cache,
+                            top_k=self.prefilter_top_k)
+
+    def _find_answers(self, pairs):
+        '''Answer (question, context) pairs, sharing batches with other
+        requests when micro-batching is enabled'''
+        if self.inference_queue is None:
+            return self._find_answers_now(pairs)
+        return self.inference_queue.submit(pairs)
 
     def _and_start_elastic_server(self):
         '''Make sure elasticsearch server is up'''
@@ -144,35 +481,53 @@ class ExcerptGen:
             # No need to do anything
             logging.info('Elasticsearch sever already running - good.')
 
-    def get_excerpts_from_docs(self, question, docs, max_page_size=512*32):
-        answers = []
-        find_answer = get_find_answer_func(self.model, question)
-        logging.info(f'Get excerpts with max_page_size={max_page_size}')
-        if self.accelerator == 'gpu':
-            for doc in docs:
-                # If p is too large it will crash the GPU...
-                logging.info(
-                    f'Splitting doc with len={len(doc)}')
-                parts = split_data(doc, max_page_size)
-                logging.info(
-                    f'Doc len {len(doc)} split into {len(parts)} parts')
-                part_answers = [find_answer(p) for p in parts]
-                answers.append(max(part_answers, key=lambda a: a['score']))
-        elif self.accelerator == 'colab':
+    def get_excerpts_from_docs(self, question, docs):
+        if self.accelerator == 'colab':
             answers = self.ask_colab(question, docs)
+            doc_answers = list(zip(answers, docs))
         else:
-            n_threads = 8
-            with ThreadPool(n_threads) as pool:
-                answers = pool.starmap(find_answer, enumerate(docs))
+            # Only docs not seen before with this question hit the model
+            keys = [(AnswerCache.normalize(question),
+                     sha1(doc.encode('utf-8')).hexdigest(),
+                     self.model_name, self.max_seq_len, self.doc_stride,
+                     self.prefilter_top_k)
+                    for doc in docs]
+            answers = [self.answer_cache.get(k) for k in keys]
+            misses = [i for i, a in enumerate(answers) if a is None]
+            n_hits = len(docs) - len(misses)
+            metrics.inc('excerpt_cache_hits', n_hits)
+            metrics.inc('excerpt_cache_misses', len(docs) - n_hits)
+            metrics.set('excerpt_cache_hit_rate', self.answer_cache.hit_rate())
+            logging.info(f'{n_hits}/{len(docs)} docs answered from cache '
+                         f'(hit rate {self.answer_cache.hit_rate():.1%})')
+            # Whole docs go through the model; windowing happens in
+            # token space
+            t0 = time()
+            miss_answers = self._find_answers(
+                [(question, docs[i]) for i in misses]) if misses else []
+            logging.info(f'Inference took {time()-t0:.1f}s')
+            for i, ans in zip(misses, miss_answers):
+                answers[i] = ans
+                self.answer_cache.put(keys[i], ans)
+            doc_answers = list(zip(answers, docs))
         # Extract answer text area
-        top_answers = sorted(enumerate(zip(answers, docs)),
+        top_answers = sorted(enumerate(doc_answers),
                              key=lambda v: v[1][0]['score'],
                              reverse=True)
-        return get_excerpts_text(top_answers)
+        return get_excerpts_text(top_answers,
+                                 sentences_before=self.sentences_before,
+                                 sentences_after=self.sentences_after,
+                                 cache=self.sentence_cache)
+
+    def get_excerpts_from_refs(self, question, refs):
+        '''Resolve document references through the document store and
+        extract excerpts from the resulting docs'''
+        with metrics.span('resolve_refs', log=False):
+            docs = self.document_store.resolve(refs)
+        return self.get_excerpts_from_docs(question, docs)
 
     def get_excerpts(self,
                      question,
-                     part_len=1024*2,
                      top_n_answers=4,
                      url='https://en.wikipedia.org/wiki/COVID-19_pandemic'):
         t0 = time()
@@ -181,17 +536,8 @@ class ExcerptGen:
         c3ai_texts = [preprocess_text(d['body'] if d['body'] else d['abstract'])
                       for d in c3ai_docs]
         web_text = get_web_data(url)
-
-        if self.accelerator in ('gpu', 'colab'):
-            # GPU/colab is fast enough to not need further text breakdown
-            parts = [web_text, *c3ai_texts]
-            logging.info(f'Data ({sum(len(p) for p in parts)}) (no split)')
-        else:
-            c3ai_text = '\n\n\n'.join(c3ai_texts)
-            evidence_pool = '\n\n\n'.join((web_text, c3ai_text))
-            parts = split_data(evidence_pool, part_len=part_len)
-            logging.info(
-                f'Data ({len(evidence_pool)}) split into {len(parts)} parts')
+        parts = [web_text, *c3ai_texts]
+        logging.info(f'Data ({sum(len(p) for p in parts)})')
         logging.info(f'Data gathering: {time()-t0:.1f}s')
 
         excerpts = self.get_excerpts_from_docs(question, parts)[:top_n_answers]
@@ -212,3 +558,103 @@ class ExcerptGen:
             logging.error(f'Colab server returned code {r.status_code}!')
             logging.error(r.content)
             return r.content
+
+
+def _token_f1(a, b):
+    a, b = a.lower().split(), b.lower().split()
+    common = sum(min(a.count(w), b.count(w)) for w in set(a))
+    if not common:
+        return float(a == b)
+    precision, recall = common / len(a), common / len(b)
+    return 2 * precision * recall / (precision + recall)
+
+
+def report_quantization_drift(
+        model_name='bert-large-uncased-whole-word-masking-finetuned-squad',
+        fixture_file='config/excerpt_fixtures.json',
+        batch_size=16,
+        intra_op_threads=None):
+    '''Compare int8 against fp32 answers and latency on a fixture set'''
+    import copy
+    with open(fixture_file, 'r') as f:
+        pairs = [(x['question'], x['context']) for x in json.load(f)]
+    fp32 = get_model(model_name, intra_op_threads=intra_op_threads)
+    int8 = quantize_model(copy.deepcopy(fp32))
+    results = {}
+    for name, model in (('fp32', fp32), ('int8', int8)):
+        find_answers(model, pairs[:1], batch_size=int(batch_size))  # warm up
+        t0 = time()
+        results[name] = find_answers(model, pairs, batch_size=int(batch_size))
+        logging.info(f'{name}: {time()-t0:.2f}s for {len(pairs)} pairs')
+    exact = f1 = score_diff = 0
+    for (question, _), a, b in zip(pairs, results['fp32'], results['int8']):
+        exact += a['answer'] == b['answer']
+        f1 += _token_f1(a['answer'], b['answer'])
+        score_diff += abs(a['score'] - b['score'])
+        if a['answer'] != b['answer']:
+            logging.info(f'Drift on "{question}": '
+                         f'"{a["answer"]}" -> "{b["answer"]}"')
+    n = len(pairs)
+    print(f'Exact span agreement: {exact/n:.1%}, token F1: {f1/n:.3f}, '
+          f'mean |score diff|: {score_diff/n:.4f}')
+
+
+def report_prefilter_recall(
+        model_name='bert-large-uncased-whole-word-masking-finetuned-squad',
+        fixture_file='config/excerpt_fixtures.json',
+        top_k=4,
+        max_seq_len=64,
+        doc_stride=16,
+        batch_size=16):
+    '''
+    Check how often the BM25 prefilter keeps the window holding the
+    model's unfiltered best answer. Every fixture question is asked
+    against all fixture contexts so that the others act as distractors.
+    '''
+    with open(fixture_file, 'r') as f:
+        fixtures = json.load(f)
+    contexts = [x['context'] for x in fixtures]
+    model = get_model(model_name)
+    kwargs = dict(batch_size=int(batch_size), max_seq_len=int(max_seq_len),
+                  doc_stride=int(doc_stride))
+    n_found = 0
+    for x in fixtures:
+        pairs = [(x['question'], c) for c in contexts]
+        metrics.reset()
+        t0 = time()
+        full = find_answers(model, pairs, **kwargs)
+        t_full = time() - t0
+        t0 = time()
+        filtered = find_answers(model, pairs, top_k=int(top_k), **kwargs)
+        t_filtered = time() - t0
+        counters = metrics.snapshot()['counters']
+        best_full = max(range(len(pairs)), key=lambda i: full[i]['score'])
+        best_filtered = max(range(len(pairs)),
+                            key=lambda i: filtered[i]['score'])
+        found = best_full == best_filtered and \
+            full[best_full]['answer'] == filtered[best_filtered]['answer']
+        n_found += found
+        logging.info(
+            f'"{x["question"]}": kept {counters["prefilter_windows_kept"]}/'
+            f'{counters["prefilter_windows"]} windows, '
+            f'{t_full:.2f}s -> {t_filtered:.2f}s, '
+            f'{"found" if found else "missed"} '
+            f'"{full[best_full]["answer"]}"')
+    print(f'Prefilter recall at top_k={top_k}: '
+          f'{n_found/len(fixtures):.1%} of {len(fixtures)} questions')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    modes = {
+        'drift': report_quantization_drift,
+        'prefilter': report_prefilter_recall,
+    }
+    if len(sys.argv) < 2 or sys.argv[1] not in modes:
+        logging.error(f'Specify mode: {"/".join(modes)}')
+        exit(1)
+    modes[sys.argv[1]](**dict(v.split('=') for v in sys.argv[2:]))
@@ -1,10 +1,12 @@
 import logging
 import json
 import sys
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 from excerpt_gen import ExcerptGen
+from excerpt_workers import ExcerptWorkerPool
 from base.config_loader import ConfigLoader
+from metrics import metrics
 
 
 class ExcerptServer(ConfigLoader):
@@ -12,8 +14,29 @@ class ExcerptServer(ConfigLoader):
         # allow command line arguments to overwrite config
         for k, v in kwargs.items():
             setattr(self, k, v)
-        eg = ExcerptGen(accelerator=self.accelerator,
-                        model_name=self.model_name)
+        gen_kwargs = dict(accelerator=self.accelerator,
+                          model_name=self.model_name,
+                          batch_size=self.batch_size,
+                          intra_op_threads=self.intra_op_threads,
+                          batch_max_pairs=self.batch_max_pairs,
+                          batch_max_wait=self.batch_max_wait,
+                          cache_size=self.cache_size,
+                          max_seq_len=self.max_seq_len,
+                          doc_stride=self.doc_stride,
+                          token_cache_size=self.token_cache_size,
+                          document_cache_size=self.document_cache_size,
+                          document_cache_max_bytes=(
+                              self.document_cache_max_bytes),
+                          model_cache_dir=self.model_cache_dir,
+                          sentences_before=self.sentences_before,
+                          sentences_after=self.sentences_after,
+                          prefilter_top_k=self.prefilter_top_k)
+        if int(self.n_workers) > 1:
+            # One model replica per process to use all cores
+            eg = ExcerptWorkerPool(self.n_workers, self.worker_cores,
+                                   **gen_kwargs)
+        else:
+            eg = ExcerptGen(**gen_kwargs, background_load=True)
 
         class RequestHandler(BaseHTTPRequestHandler):
             def _set_response(self):
@@ -21,7 +44,40 @@ class ExcerptServer(ConfigLoader):
                 self.send_header('Content-type', 'application/json')
                 self.end_headers()
 
+            def _send_status(self, code, status):
+                self.send_response(code)
+                self.send_header('Content-type', 'application/json')
+                self.end_headers()
+                self.wfile.write(json.dumps(status).encode('utf-8'))
+
+            def do_GET(self):
+                if self.path == '/healthz':
+                    # The process is up and serving, even if still loading
+                    self._send_status(200, {'status': 'ok'})
+                    return
+                if self.path == '/readyz':
+                    if eg.ready.is_set():
+                        self._send_status(200, {'status': 'ready'})
+                    elif eg.load_error is not None:
+                        self._send_status(
+                            503, {'status': 'failed',
+                                  'error': repr(eg.load_error)})
+                    else:
+                        self._send_status(503, {'status': 'loading'})
+                    return
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-type', 'text/plain; version=0.0.4')
+                self.end_headers()
+                self.wfile.write(metrics.to_prometheus().encode('utf-8'))
+
             def do_POST(self):
+                if not eg.ready.is_set():
+                    self._send_status(503, {'error': 'Model is not ready'})
+                    return
                 # refuse to receive non-json content
                 ctype = self.headers['Content-Type']
                 if ctype != 'application/json':
@@ -36,6 +92,8 @@ class ExcerptServer(ConfigLoader):
                     response = self._get_excerpts(body)
                 elif self.path == '/get_excerpts_from_docs':
                     response = self._get_excerpts_from_docs(body)
+                elif self.path == '/get_excerpts_from_refs':
+                    response = self._get_excerpts_from_refs(body)
                 else:
                     logging.info(f'Got path={self.path}')
                     self.send_response(400)
@@ -69,7 +127,22 @@ class ExcerptServer(ConfigLoader):
                     }
                 return response
 
-        httpd = HTTPServer((self.host, self.port), RequestHandler)
+            def _get_excerpts_from_refs(self, body):
+                message = json.loads(body)
+                question = message.get('question', '')
+                refs = message.get('refs', [])
+                if question and refs:
+                    response = eg.get_excerpts_from_refs(question, refs)
+                else:
+                    response = {
+                        'error': (f'No question (len={len(question)}) or '
+                                  f'refs (len={len(refs)}) provided')
+                    }
+                return response
+
+        # Handle requests on separate threads so that their inference can
+        # be batched together
+        httpd = ThreadingHTTPServer((self.host, self.port), RequestHandler)
         logging.info(f'Listening on {self.host}:{self.port}')
         try:
             httpd.serve_forever()
@@ -77,6 +150,8 @@ class ExcerptServer(ConfigLoader):
             logging.info('KeyboardInterrupt')
         finally:
             httpd.server_close()
+            if isinstance(eg, ExcerptWorkerPool):
+                eg.close()
 
 
 if __name__ == '__main__':
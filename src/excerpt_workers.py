@@ -0,0 +1,202 @@
+# Pool of excerpt generator processes for many-core machines
+import logging
+import multiprocessing as mp
+import os
+import queue
+import threading
+from itertools import count
+from time import time
+
+from excerpt_gen import ExcerptGen, fill_model_cache
+from metrics import metrics
+
+
+def split_cores(n_workers):
+    '''Divide the usable cores into n_workers contiguous sets'''
+    cores = sorted(os.sched_getaffinity(0))
+    size = max(len(cores) // n_workers, 1)
+    return [cores[i*size:(i+1)*size] or cores for i in range(n_workers)]
+
+
+def _worker_main(worker_id, cores, gen_kwargs, tasks, results):
+    '''Load a model replica pinned to cores and answer tasks until told
+    to stop with None'''
+    if cores:
+        os.sched_setaffinity(0, cores)
+        if not gen_kwargs.get('intra_op_threads'):
+            gen_kwargs = {**gen_kwargs, 'intra_op_threads': len(cores)}
+    logging.info(f'Worker {worker_id} loading on cores {cores}')
+    eg = ExcerptGen(**gen_kwargs)
+    results.put((worker_id, None, eg.ready.is_set(), repr(eg.load_error)))
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        task_id, method, args, kwargs = task
+        try:
+            results.put((worker_id, task_id,
+                         getattr(eg, method)(*args, **kwargs), None))
+        except Exception as e:
+            results.put((worker_id, task_id, None, repr(e)))
+
+
+class ExcerptWorkerPool:
+    '''
+    Runs n_workers ExcerptGen replicas in their own processes, each
+    pinned to its own set of cores, and sends every request to the ready
+    worker with the fewest requests in flight. Exposes the same request
+    methods and readiness attributes as ExcerptGen. With a model_cache_dir,
+    the cache is filled once before any worker starts so that workers only
+    ever read it.
+    '''
+
+    def __init__(self, n_workers, worker_cores=None, **gen_kwargs):
+        n_workers = int(n_workers)
+        worker_cores = worker_cores or split_cores(n_workers)
+        ctx = mp.get_context('fork')
+        self.results = ctx.Queue()
+        self.task_queues = [ctx.Queue() for _ in range(n_workers)]
+        self.new_processes = [
+            ctx.Process(target=_worker_main,
+                        args=(i, worker_cores[i], gen_kwargs,
+                              self.task_queues[i], self.results),
+                        name=f'excerpt-worker-{i}', daemon=True)
+            for i in range(n_workers)
+        ]
+        # Started processes
+        self.processes = []
+        self.worker_ready = [False] * n_workers
+        self.worker_done = [False] * n_workers
+        self.in_flight = [0] * n_workers
+        # task_id -> {'worker', 'done', 'result', 'error'}
+        self.pending = {}
+        self.task_ids = count()
+        self.lock = threading.Lock()
+        # Ready as soon as one worker can take requests
+        self.ready = threading.Event()
+        self.load_error = None
+        threading.Thread(target=self._start, args=(gen_kwargs,),
+                         daemon=True, name='excerpt-worker-start').start()
+
+    def _start(self, gen_kwargs):
+        if gen_kwargs.get('model_cache_dir') and \
+                gen_kwargs.get('accelerator', 'cpu').lower() != 'colab':
+            # In a fresh process: torch must not be loaded in this one
+            # before forking the workers
+            filler = mp.get_context('spawn').Process(
+                target=fill_model_cache,
+                args=(gen_kwargs['model_name'],
+                      gen_kwargs['model_cache_dir'],
+                      gen_kwargs.get('accelerator') == 'cpu-int8'),
+                name='excerpt-model-cache')
+            filler.start()
+            filler.join()
+            if filler.exitcode != 0:
+                error = f'filling the model cache exited with ' \
+                        f'{filler.exitcode}'
+                logging.error(f'Could not start workers: {error}')
+                self.load_error = RuntimeError(error)
+                return
+        for p in self.new_processes:
+            p.start()
+            self.processes.append(p)
+        threading.Thread(target=self._collect, daemon=True,
+                         name='excerpt-worker-results').start()
+
+    def _on_loaded(self, worker_id, ok, error):
+        with self.lock:
+            self.worker_done[worker_id] = True
+            self.worker_ready[worker_id] = ok
+            if ok:
+                logging.info(f'Worker {worker_id} is ready')
+                self.ready.set()
+            else:
+                logging.error(f'Worker {worker_id} failed to load: {error}')
+                if all(self.worker_done) and not any(self.worker_ready):
+                    self.load_error = RuntimeError(error)
+        metrics.set(f'excerpt_worker_{worker_id}_ready', int(ok))
+
+    def _finish(self, task_id, result=None, error=None):
+        with self.lock:
+            job = self.pending.pop(task_id, None)
+            if job is None:
+                return
+            self.in_flight[job['worker']] -= 1
+            in_flight = self.in_flight[job['worker']]
+        metrics.set(f'excerpt_worker_{job["worker"]}_in_flight', in_flight)
+        job['result'] = result
+        job['error'] = error
+        job['done'].set()
+
+    def _check_workers(self):
+        '''Stop dispatching to dead workers and fail their requests'''
+        for worker_id, p in enumerate(self.processes):
+            if p.is_alive():
+                continue
+            if not self.worker_done[worker_id]:
+                self._on_loaded(worker_id, False,
+                                f'exited with {p.exitcode} while loading')
+                continue
+            if not self.worker_ready[worker_id]:
+                continue
+            logging.error(f'Worker {worker_id} exited with {p.exitcode}')
+            with self.lock:
+                self.worker_ready[worker_id] = False
+                if not any(self.worker_ready):
+                    self.ready.clear()
+                lost = [t for t, job in self.pending.items()
+                        if job['worker'] == worker_id]
+            metrics.set(f'excerpt_worker_{worker_id}_ready', 0)
+            for task_id in lost:
+                self._finish(task_id, error=f'Worker {worker_id} died')
+
+    def _collect(self):
+        while True:
+            try:
+                worker_id, task_id, result, error = \
+                    self.results.get(timeout=1)
+            except queue.Empty:
+                self._check_workers()
+                continue
+            if task_id is None:
+                self._on_loaded(worker_id, result, error)
+            else:
+                self._finish(task_id, result, error)
+
+    def _call(self, method, *args, **kwargs):
+        '''Run an ExcerptGen method on the least loaded ready worker'''
+        with self.lock:
+            ready = [i for i, r in enumerate(self.worker_ready) if r]
+            if not ready:
+                raise RuntimeError('No excerpt worker is ready')
+            worker_id = min(ready, key=lambda i: self.in_flight[i])
+            self.in_flight[worker_id] += 1
+            in_flight = self.in_flight[worker_id]
+            task_id = next(self.task_ids)
+            job = {'worker': worker_id, 'done': threading.Event()}
+            self.pending[task_id] = job
+        metrics.set(f'excerpt_worker_{worker_id}_in_flight', in_flight)
+        metrics.inc(f'excerpt_worker_{worker_id}_requests')
+        t0 = time()
+        self.task_queues[worker_id].put((task_id, method, args, kwargs))
+        job['done'].wait()
+        metrics.observe(f'excerpt_worker_{worker_id}', time() - t0)
+        if job['error'] is not None:
+            metrics.inc(f'excerpt_worker_{worker_id}_errors')
+            raise RuntimeError(job['error'])
+        return job['result']
+
+    def get_excerpts(self, question, **kwargs):
+        return self._call('get_excerpts', question, **kwargs)
+
+    def get_excerpts_from_docs(self, question, docs):
+        return self._call('get_excerpts_from_docs', question, docs)
+
+    def get_excerpts_from_refs(self, question, refs):
+        return self._call('get_excerpts_from_refs', question, refs)
+
+    def close(self):
+        for q in self.task_queues:
+            q.put(None)
+        for p in self.processes:
+            p.join(timeout=5)
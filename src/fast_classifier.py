@@ -0,0 +1,294 @@
+# Local classifier cascade answering easy intent/question type cases
+# before falling back to GPT-3.
+# Usage:
+#   python src/fast_classifier.py train [model_file=...] [logs_dir=...]
+#       [holdout=0.2]
+#   python src/fast_classifier.py evaluate [model_file=...] [logs_dir=...]
+#       [holdout=0.2]
+# evaluate reports on the messages train held out, so both must be given
+# the same holdout fraction.
+import json
+import logging
+import os
+import re
+import sys
+from collections import Counter
+from glob import glob
+from hashlib import sha1
+
+import numpy as np
+from scipy import sparse
+
+from intent_type import IntentType
+from question_type import QuestionType
+from metrics import metrics
+
+label_types = {
+    'intent': IntentType,
+    'question_type': QuestionType,
+}
+
+
+def tokenize(text):
+    '''Lowercase word unigrams and bigrams'''
+    words = re.findall(r'[a-z0-9#\']+', text.lower())
+    return words + [f'{a} {b}' for a, b in zip(words, words[1:])]
+
+
+class LinearTextModel:
+    '''Sparse TF-IDF features fed into a softmax regression'''
+
+    def __init__(self, vocab, idf, weights, bias, classes):
+        self.vocab = vocab
+        self.idf = idf
+        self.weights = weights
+        self.bias = bias
+        self.classes = classes
+
+    @classmethod
+    def _featurize(cls, texts, vocab, idf):
+        '''L2-normalized TF-IDF rows as a sparse matrix'''
+        rows, cols, counts = [], [], []
+        for i, text in enumerate(texts):
+            for term, count in Counter(tokenize(text)).items():
+                j = vocab.get(term)
+                if j is not None:
+                    rows.append(i)
+                    cols.append(j)
+                    counts.append(count)
+        x = sparse.csr_matrix(
+            (np.array(counts, dtype=np.float32), (rows, cols)),
+            shape=(len(texts), len(vocab)))
+        x = x @ sparse.diags(idf)
+        norms = np.sqrt(np.asarray(x.multiply(x).sum(axis=1))).ravel()
+        return sparse.diags(1 / np.maximum(norms, 1e-12)) @ x
+
+    @classmethod
+    def train(cls, texts, labels, min_df=1, epochs=300, lr=2.0, l2=1e-3):
+        '''Fit with class-balanced example weights so that a dominant
+        label does not swamp the rare ones'''
+        classes = sorted(set(labels))
+        df = Counter(t for text in texts for t in set(tokenize(text)))
+        terms = sorted(t for t, c in df.items() if c >= min_df)
+        vocab = {t: i for i, t in enumerate(terms)}
+        idf = np.log((1 + len(texts)) /
+                     (1 + np.array([df[t] for t in terms],
+                                   dtype=np.float32))) + 1
+        x = cls._featurize(texts, vocab, idf)
+        label_i = [classes.index(label) for label in labels]
+        y = np.zeros((len(texts), len(classes)), dtype=np.float32)
+        y[np.arange(len(texts)), label_i] = 1
+        class_weights = len(texts) / (len(classes) * y.sum(axis=0))
+        example_weights = class_weights[label_i][:, None]
+        weights = np.zeros((len(vocab), len(classes)), dtype=np.float32)
+        bias = np.zeros(len(classes), dtype=np.float32)
+        for _ in range(epochs):
+            probs = cls._softmax(x @ weights + bias)
+            grad = (probs - y) * example_weights
+            weights -= lr * (x.T @ grad / len(texts) + l2 * weights)
+            bias -= lr * grad.mean(axis=0)
+        return cls(vocab, idf, weights, bias, classes)
+
+    @classmethod
+    def _softmax(cls, logits):
+        e = np.exp(logits - logits.max(axis=1, keepdims=True))
+        return e / e.sum(axis=1, keepdims=True)
+
+    def predict(self, text):
+        '''Return (label, probability)'''
+        x = self._featurize([text], self.vocab, self.idf)
+        probs = self._softmax(x @ self.weights + self.bias)[0]
+        best = int(probs.argmax())
+        return self.classes[best], float(probs[best])
+
+    def to_dict(self):
+        return {
+            'vocab': list(self.vocab),
+            'idf': self.idf.tolist(),
+            'weights': self.weights.tolist(),
+            'bias': self.bias.tolist(),
+            'classes': self.classes,
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls({t: i for i, t in enumerate(d['vocab'])},
+                   np.array(d['idf'], dtype=np.float32),
+                   np.array(d['weights'], dtype=np.float32),
+                   np.array(d['bias'], dtype=np.float32),
+                   d['classes'])
+
+
+class FastClassifier:
+    '''
+    Cascade of (1) hand written rules and (2) a small linear model. Each
+    predict method returns None when neither is confident enough, in which
+    case the caller should ask GPT-3.
+    '''
+    question_regex = re.compile(
+        r'^(what|when|where|which|who|whom|whose|why|how|is|are|was|were|'
+        r'do|does|did|can|could|should|would|will|has|have)\b.*\?$')
+    over_regex = re.compile(
+        r'^(thanks|thank you|thx|ty|bye|goodbye|got it|cool|great)'
+        r'[\.\!]*$')
+    about_me_regex = re.compile(r'\b(you|your|yourself)\b')
+
+    def __init__(self,
+                 model_file='data/fast_classifier.json',
+                 threshold=0.9,
+                 graph_hashtags=[]):
+        self.threshold = threshold
+        self.graph_hashtags = graph_hashtags
+        self.models = {}
+        if model_file and os.path.exists(model_file):
+            with open(model_file, 'r') as f:
+                self.models = {task: LinearTextModel.from_dict(d)
+                               for task, d in json.load(f).items()}
+            logging.info(f'Loaded fast classifier models: {list(self.models)}')
+
+    def _rule_intent(self, msg):
+        msg = msg.lower().strip()
+        if self.over_regex.match(msg):
+            return IntentType.Over
+        if self.question_regex.match(msg) and \
+                self.about_me_regex.search(msg) is None:
+            return IntentType.Question
+        return None
+
+    def _rule_question_type(self, msg):
+        if any(ht in msg.lower() for ht in self.graph_hashtags):
+            return QuestionType.Stats
+        return None
+
+    def _predict(self, task, msg):
+        rule = getattr(self, f'_rule_{task}')(msg)
+        if rule is not None:
+            metrics.inc(f'fast_{task}_rule_hits')
+            return rule
+        model = self.models.get(task)
+        if model is not None:
+            label, prob = model.predict(msg)
+            if prob >= self.threshold:
+                metrics.inc(f'fast_{task}_model_hits')
+                return label_types[task][label]
+        metrics.inc(f'fast_{task}_fallbacks')
+        return None
+
+    def predict_intent(self, msg):
+        return self._predict('intent', msg)
+
+    def predict_question_type(self, msg):
+        return self._predict('question_type', msg)
+
+
+def load_history(logs_dir='logs'):
+    '''
+    Collect labelled messages per task from GPT-3 decisions recorded in
+    classifications.jsonl and from answer logs (which are all questions).
+    Answer logs do not seed question_type: they are written for textual
+    and statistical answers alike and would drown out the other types.
+    '''
+    history = {task: [] for task in label_types}
+    for path in glob(os.path.join(logs_dir, '*.json')):
+        with open(path, 'r') as f:
+            question = json.load(f).get('question', '')
+        # Answer logs have the COVID header prepended to the question
+        question = question.split(': ', 1)[-1]
+        if question:
+            history['intent'].append((question, IntentType.Question.name))
+    labels_file = os.path.join(logs_dir, 'classifications.jsonl')
+    if os.path.exists(labels_file):
+        with open(labels_file, 'r') as f:
+            for line in f:
+                record = json.loads(line)
+                history[record['task']].append(
+                    (record['msg'], record['label']))
+    return history
+
+
+def in_holdout(msg, holdout):
+    '''Whether msg is held out of training. Decided by message hash, so
+    that repeated messages never end up on both sides.'''
+    return int(sha1(msg.encode('utf-8')).hexdigest(), 16) % 1000 < \
+        float(holdout) * 1000
+
+
+def split_history(history, holdout):
+    '''Split labelled messages per task into training and held-out sets'''
+    train_history = {task: [] for task in history}
+    test_history = {task: [] for task in history}
+    for task, examples in history.items():
+        for msg, label in examples:
+            split = test_history if in_holdout(msg, holdout) \
+                else train_history
+            split[task].append((msg, label))
+    return train_history, test_history
+
+
+def train(model_file='data/fast_classifier.json', logs_dir='logs',
+          holdout=0.2):
+    '''Train on the history except a holdout fraction kept for evaluate'''
+    history, test_history = split_history(load_history(logs_dir), holdout)
+    n_held_out = {task: len(e) for task, e in test_history.items()}
+    logging.info(f'Held out {n_held_out} examples for evaluation')
+    models = {}
+    for task, examples in history.items():
+        labels = [label for _, label in examples]
+        if len(set(labels)) < 2:
+            logging.warning(f'Not enough label variety to train {task}: '
+                            f'{Counter(labels)}')
+            continue
+        logging.info(f'Training {task} on {len(examples)} examples '
+                     f'{dict(Counter(labels))}')
+        models[task] = LinearTextModel.train(
+            [m for m, _ in examples], labels).to_dict()
+    os.makedirs(os.path.dirname(model_file) or '.', exist_ok=True)
+    with open(model_file, 'w') as f:
+        json.dump(models, f)
+    logging.info(f'Saved {list(models)} to {model_file}')
+
+
+def evaluate(model_file='data/fast_classifier.json', logs_dir='logs',
+             threshold=0.9, graph_hashtags='#graph,#plot,#draw,#curves',
+             holdout=0.2):
+    '''Report cascade hit rate, agreement with GPT-3 labels and recall
+    per label on the messages held out of training'''
+    clf = FastClassifier(model_file, float(threshold),
+                         graph_hashtags.split(','))
+    _, test_history = split_history(load_history(logs_dir), holdout)
+    for task, examples in test_history.items():
+        predict = getattr(clf, f'predict_{task}')
+        hits = correct = 0
+        n_label = Counter()
+        n_recalled = Counter()
+        for msg, label in examples:
+            n_label[label] += 1
+            pred = predict(msg)
+            if pred is not None:
+                hits += 1
+                correct += pred.name == label
+                n_recalled[label] += pred.name == label
+        n = max(len(examples), 1)
+        print(f'{task}: {len(examples)} examples, '
+              f'hit rate {hits/n:.1%}, '
+              f'agreement on hits {correct/max(hits, 1):.1%}')
+        # Fallbacks to GPT-3 count as not recalled
+        for label, count in sorted(n_label.items()):
+            print(f'  {label}: {count} examples, '
+                  f'recall {n_recalled[label]/count:.1%}')
+
+
+if __name__ == '__main__':
+    logging.basicConfig(
+        format='%(asctime)s %(levelname)-8s %(message)s',
+        level=logging.INFO,
+        datefmt='%Y-%m-%d %H:%M:%S'
+    )
+    if len(sys.argv) < 2:
+        logging.error('Specify mode: train or evaluate')
+        exit(1)
+    kwargs = dict(v.split('=') for v in sys.argv[2:])
+    if sys.argv[1] == 'train':
+        train(**kwargs)
+    elif sys.argv[1] == 'evaluate':
+        evaluate(**kwargs)
@@ -0,0 +1,88 @@
+# Central queue coalescing inference work from concurrent requests
+import logging
+import queue
+import threading
+from time import time
+
+from metrics import metrics
+
+
+class InferenceJob:
+    '''Pairs submitted by one request and, once done, their answers'''
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+        self.answers = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InferenceQueue:
+    '''
+    Requests submit (question, context) pairs and block until answered.
+    A worker thread takes the oldest job, keeps collecting further jobs
+    for up to max_wait seconds or until max_pairs pairs are gathered, and
+    runs them all through run_batch in one go.
+    '''
+
+    def __init__(self, run_batch, max_pairs=64, max_wait=0.01, n_workers=1):
+        self.run_batch = run_batch
+        self.max_pairs = int(max_pairs)
+        self.max_wait = float(max_wait)
+        self.jobs = queue.Queue()
+        for i in range(int(n_workers)):
+            threading.Thread(target=self._work, daemon=True,
+                             name=f'inference-{i}').start()
+
+    def submit(self, pairs):
+        '''Queue pairs for inference and wait for their answers'''
+        job = InferenceJob(pairs)
+        self.jobs.put(job)
+        metrics.set('inference_queue_depth', self.jobs.qsize())
+        job.done.wait()
+        if job.error is not None:
+            raise job.error
+        return job.answers
+
+    def _collect(self):
+        '''Block for one job, then coalesce more within the time window'''
+        jobs = [self.jobs.get()]
+        n_pairs = len(jobs[0].pairs)
+        window_end = time() + self.max_wait
+        while n_pairs < self.max_pairs:
+            timeout = window_end - time()
+            if timeout <= 0:
+                break
+            try:
+                job = self.jobs.get(timeout=timeout)
+            except queue.Empty:
+                break
+            jobs.append(job)
+            n_pairs += len(job.pairs)
+        metrics.set('inference_queue_depth', self.jobs.qsize())
+        return jobs
+
+    def _work(self):
+        while True:
+            jobs = self._collect()
+            pairs = [p for job in jobs for p in job.pairs]
+            metrics.inc('inference_batches')
+            metrics.inc('inference_batched_requests', len(jobs))
+            metrics.inc('inference_batched_pairs', len(pairs))
+            try:
+                with metrics.span('inference_batch', log=False):
+                    answers = self.run_batch(pairs)
+            except Exception as e:
+                logging.error(f'Inference of {len(pairs)} pairs from '
+                              f'{len(jobs)} requests failed due to {e}')
+                for job in jobs:
+                    job.error = e
+                    job.done.set()
+                continue
+            logging.info(f'Answered {len(pairs)} pairs from '
+                         f'{len(jobs)} requests in one batch')
+            i = 0
+            for job in jobs:
+                job.answers = answers[i:i+len(job.pairs)]
+                i += len(job.pairs)
+                job.done.set()
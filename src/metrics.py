@@ -0,0 +1,171 @@
+# In-process latency histograms and counters with a Prometheus text endpoint
+import logging
+import re
+import threading
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from time import time
+
+
+class Histogram:
+    '''Keeps a window of the latest samples to report percentiles'''
+
+    def __init__(self, max_samples=10000):
+        self.samples = deque(maxlen=max_samples)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        self.samples.append(value)
+        self.count += 1
+        self.total += value
+
+    def percentiles(self, quantiles):
+        '''Nearest-rank percentiles over the sample window'''
+        ordered = sorted(self.samples)
+        if not ordered:
+            return {q: 0.0 for q in quantiles}
+        return {
+            q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+            for q in quantiles
+        }
+
+
+class Metrics:
+    '''
+    Registry of named latency histograms (spans), counters and gauges. All
+    methods are thread-safe so stages running on worker pools can report
+    into the same registry.
+    '''
+    quantiles = (0.5, 0.95, 0.99)
+
+    def __init__(self, prefix='covidprof', max_samples=10000):
+        self.prefix = prefix
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        '''Forget all recorded values'''
+        with self.lock:
+            self.histograms = {}
+            self.counters = {}
+            self.gauges = {}
+
+    def observe(self, name, value):
+        '''Record a latency sample (in seconds) for a named stage'''
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = Histogram(self.max_samples)
+            self.histograms[name].observe(value)
+
+    def inc(self, name, value=1):
+        '''Increment a named counter'''
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value):
+        '''Set a named gauge to its current value'''
+        with self.lock:
+            self.gauges[name] = value
+
+    @contextmanager
+    def span(self, name, log=True):
+        '''Time the enclosed block as one sample of the named stage'''
+        t0 = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - t0
+            self.observe(name, elapsed)
+            if log:
+                logging.info(f'{name} took {elapsed:.1f}s')
+
+    def snapshot(self):
+        '''Return current percentiles and counters as plain dicts'''
+        with self.lock:
+            stages = {
+                name: {
+                    'count': h.count,
+                    'sum': h.total,
+                    **{f'p{int(q*100)}': v
+                       for q, v in h.percentiles(self.quantiles).items()},
+                }
+                for name, h in self.histograms.items()
+            }
+            counters = dict(self.counters)
+            gauges = dict(self.gauges)
+        return {'stages': stages, 'counters': counters, 'gauges': gauges}
+
+    def format_table(self):
+        '''Human readable stage latency table sorted by total time'''
+        snap = self.snapshot()
+        lines = [f'{"stage":<28}{"count":>8}{"p50":>9}{"p95":>9}'
+                 f'{"p99":>9}{"total":>10}']
+        for name, s in sorted(snap['stages'].items(),
+                              key=lambda kv: kv[1]['sum'], reverse=True):
+            lines.append(f'{name:<28}{s["count"]:>8}{s["p50"]:>9.3f}'
+                         f'{s["p95"]:>9.3f}{s["p99"]:>9.3f}{s["sum"]:>10.2f}')
+        for name, v in sorted({**snap['counters'],
+                               **snap['gauges']}.items()):
+            lines.append(f'{name:<28}{v:>8}')
+        return '\n'.join(lines)
+
+    @classmethod
+    def _sanitize(cls, name):
+        return re.sub(r'[^a-zA-Z0-9_]', '_', name)
+
+    def to_prometheus(self):
+        '''Render metrics in the Prometheus text exposition format'''
+        snap = self.snapshot()
+        stage_metric = f'{self.prefix}_stage_seconds'
+        lines = [f'# TYPE {stage_metric} summary']
+        for name, s in sorted(snap['stages'].items()):
+            label = f'stage="{self._sanitize(name)}"'
+            for q in self.quantiles:
+                lines.append(f'{stage_metric}{{{label},quantile="{q}"}} '
+                             f'{s[f"p{int(q*100)}"]}')
+            lines.append(f'{stage_metric}_sum{{{label}}} {s["sum"]}')
+            lines.append(f'{stage_metric}_count{{{label}}} {s["count"]}')
+        for name, v in sorted(snap['counters'].items()):
+            counter_metric = f'{self.prefix}_{self._sanitize(name)}_total'
+            lines.append(f'# TYPE {counter_metric} counter')
+            lines.append(f'{counter_metric} {v}')
+        for name, v in sorted(snap['gauges'].items()):
+            gauge_metric = f'{self.prefix}_{self._sanitize(name)}'
+            lines.append(f'# TYPE {gauge_metric} gauge')
+            lines.append(f'{gauge_metric} {v}')
+        return '\n'.join(lines) + '\n'
+
+    def serve(self, host='127.0.0.1', port=9100):
+        '''Serve /metrics on a daemon thread'''
+        registry = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/metrics':
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = registry.to_prometheus().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type',
+                                 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                # Scrapes are too frequent to be logged
+                pass
+
+        httpd = ThreadingHTTPServer((host, port), MetricsHandler)
+        thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+        thread.start()
+        logging.info(f'Serving metrics on http://{host}:{port}/metrics')
+        return httpd
+
+
+# Default registry shared by all pipeline components
+metrics = Metrics()
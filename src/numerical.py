@@ -1,16 +1,23 @@
 from adapter.c3aidatalake import evalmetrics
 from adapter.gpt3 import GPT3Adapter
+from metrics import metrics
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import re
 import json
 import logging
+import threading
 
+import requests
 import seaborn as sns
 import matplotlib
 matplotlib.use('Agg')
+import matplotlib.pyplot as plt  # noqa: E402
 sns.set()
 
+# pyplot keeps global figure state, so only one thread may plot at a time
+plot_lock = threading.Lock()
+
 
 def parse_date(date_str):
     return datetime.strptime(date_str, '%Y-%m-%d').date()
@@ -22,6 +29,9 @@ def pretty_location(ugly_location):
 
 
 class Numerical():
+    out_of_time_reply = ('It is taking me too long to get that data right '
+                         'now. Could you ask again in a bit?')
+
     def __init__(self):
         self.gpt3 = GPT3Adapter()
 
@@ -47,8 +57,12 @@ class Numerical():
             # user we couldn't find the data
             return None, None
 
-    def handle_request(self, text):
-        spec_str = self.gpt3.parse_numerical_query(text)
+    def handle_request(self, text, deadline=None):
+        with metrics.span('stats_parse_query'):
+            spec_str = self.gpt3.parse_numerical_query(
+                text, deadline=deadline)
+        if spec_str is None:
+            return self.out_of_time_reply, None
         spec_json_str = self._clean_spec_str(spec_str)
         df = None
         try:
@@ -74,7 +88,14 @@ class Numerical():
             logging.info(f'Final numerical spec: {spec}')
             # Map metric name for labels etc
             loc_str = pretty_location(spec['location'])
-            df, data_source = self.fetch_data(spec)
+            try:
+                with metrics.span('stats_fetch_data'):
+                    df, data_source = self.fetch_data(spec, deadline=deadline)
+            except (TimeoutError, requests.exceptions.Timeout) as e:
+                logging.error(f'Could not fetch data in time: {e}')
+                if deadline is not None:
+                    deadline.degrade('stats_data')
+                return self.out_of_time_reply, None
             # Deal with when data couldn't be fetched
             metric_name = {
                 'case': 'Confirmed Cases',
@@ -105,15 +126,20 @@ class Numerical():
         df = df.rename(columns={data_col: 'metric'})
         df = df.loc[:, ['dates', 'metric']].sort_values('dates')
         # Make figure
-        ax = df.plot.line(x='dates', lw=3, color='orange',
-                          figsize=(7, 4), legend=False)
-        ax.set_xlabel('Dates', fontsize=12)
-        ax.set_ylabel(f'No. of {metric_name}', fontsize=12)
-        ax.set_title(f'{data_source} {metric_name} in {loc_str}', fontsize=16)
-        f = ax.get_figure()
-        f.tight_layout()
-        png_filename = 'stats_graph.png'
-        f.savefig(png_filename, format='png')
+        # Name the graph after the handling thread so that concurrent
+        # requests do not overwrite each other's graph before uploading
+        png_filename = f'stats_graph_{threading.get_ident()}.png'
+        with metrics.span('stats_plot'), plot_lock:
+            ax = df.plot.line(x='dates', lw=3, color='orange',
+                              figsize=(7, 4), legend=False)
+            ax.set_xlabel('Dates', fontsize=12)
+            ax.set_ylabel(f'No. of {metric_name}', fontsize=12)
+            ax.set_title(f'{data_source} {metric_name} in {loc_str}',
+                         fontsize=16)
+            f = ax.get_figure()
+            f.tight_layout()
+            f.savefig(png_filename, format='png')
+            plt.close(f)
         diff = int(df.iloc[-1].metric - df.iloc[0].metric)
         if diff != 0:
             inc_red_str = 'increased' if diff > 0 else 'reduced'
@@ -136,7 +162,10 @@ class Numerical():
     @classmethod
     def fetch_data(cls,
                    spec,
-                   sources=['NYT', 'JHU', 'ECDC', 'CovidTrackingProject']):
+                   sources=['NYT', 'JHU', 'ECDC', 'CovidTrackingProject'],
+                   deadline=None):
+        '''Fetch the first source with data, each request bounded by the
+        remaining budget of the deadline (raising TimeoutError once spent)'''
         metric = spec['type']
         if metric == 'recovery':
             sources = ['JHU']
@@ -152,8 +181,14 @@ class Numerical():
             evalmetrics_expressions = \
                 cls.gen_evalmetrics_expressions(metric, source)
             for id_ in evalmetrics_ids:
+                timeout = None
+                if deadline is not None:
+                    if deadline.expired():
+                        raise TimeoutError('C3.ai deadline expired')
+                    timeout = deadline.timeout()
                 df = cls.evalmetrics_request(
-                    [id_], evalmetrics_expressions, spec['from'], spec['to'])
+                    [id_], evalmetrics_expressions, spec['from'], spec['to'],
+                    timeout=timeout)
                 all_cols.extend(df.columns)
                 # Discard df if all missing
                 missing_col = next(
@@ -170,7 +205,8 @@ class Numerical():
         return data, source
 
     @classmethod
-    def evalmetrics_request(cls, ids, expressions, from_date, to_date):
+    def evalmetrics_request(cls, ids, expressions, from_date, to_date,
+                            timeout=None):
         table_name = "outbreaklocation"
         body = {
             'spec': {
@@ -181,7 +217,7 @@ class Numerical():
                 'end': to_date.strftime("%Y-%m-%d"),
             }
         }
-        return evalmetrics(table_name, body, get_all=True)
+        return evalmetrics(table_name, body, get_all=True, timeout=timeout)
 
     @classmethod
     def gen_evalmetrics_ids(cls, location):
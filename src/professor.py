@@ -2,11 +2,13 @@
 import logging
 import re
 import sys
+import threading
 from time import time
 import RAKE
 from multiprocessing.pool import ThreadPool
 
 from adapter.elastic_search import ElasticSearchAdapter as SearchEngine
+from adapter.elastic_search import AuxPassageMapping
 from adapter.twitter import TwitterAdapter
 from adapter.c3ai import C3aiAdapter
 from adapter.gpt3 import GPT3Adapter
@@ -15,6 +17,9 @@ from question_type import QuestionType
 from numerical import Numerical
 from base.config_loader import ConfigLoader
 from intent_type import IntentType
+from metrics import metrics
+from answer_cache import AnswerCache
+from deadline import Deadline
 
 rake = RAKE.Rake(RAKE.SmartStopList())
 
@@ -31,21 +36,67 @@ class Professor(ConfigLoader):
             r'^ok[\.\,\!\?]*$',
         ]
     ]
+    # Answers in which GPT-3 admits not knowing
+    failsafe_phrases = ('i don\'t know.', 'i\'m not sure.')
 
-    def __init__(self):
+    def __init__(self, config_file=None):
         '''Constructor'''
-        super().__init__()
-        # Initialize components
+        super().__init__(config_file=config_file)
+        # Whole requests run on a bounded pool so that one slow question
+        # does not hold up the others. I/O-bound stages within a request
+        # share a separate pool so they cannot starve request workers.
+        self.request_pool = ThreadPool(self.max_concurrent_requests)
+        self.stage_pool = ThreadPool(self.max_stage_threads)
+        self._init_components()
+        self.answer_cache = None
+        if self.answer_cache_size > 0:
+            self.answer_cache = AnswerCache(
+                path=self.answer_cache_file,
+                max_entries=self.answer_cache_size,
+                ttl=self.answer_cache_ttl)
+        if self.metrics_port:
+            metrics.serve(self.metrics_host, self.metrics_port)
+
+    def _init_components(self):
+        '''Initialize external service adapters'''
         self.messaging = TwitterAdapter(message_handler=self.message_handler)
-        self.search_engine = SearchEngine()
+        # Repeated queries are served from the outermost engine's cache
+        cache = dict(cache_size=self.search_cache_size,
+                     cache_ttl=self.search_cache_ttl,
+                     cache_max_bytes=self.search_cache_max_bytes)
+        if self.search_backend == 'tantivy':
+            from adapter.tantivy_search import TantivyAdapter
+            from adapter.tantivy_search import aux_passage_fields
+            self.search_engine = TantivyAdapter(**cache)
+            self.aux_search_engine = TantivyAdapter(
+                index_path='data/tantivy_aux_index',
+                fields=aux_passage_fields,
+                generation_file='data/aux_index_generation', **cache)
+        elif self.search_backend == 'hybrid':
+            from adapter.dense_search import DenseSearchAdapter
+            self.search_engine = DenseSearchAdapter(
+                SearchEngine(),
+                index_dir=self.dense_index_dir,
+                model_name=self.dense_model_name,
+                n_candidates=self.dense_n_candidates,
+                n_probe=self.dense_n_probe,
+                **cache)
+            self.aux_search_engine = SearchEngine(
+                mapping=AuxPassageMapping,
+                generation_file='data/aux_index_generation', **cache)
+        else:
+            self.search_engine = SearchEngine(**cache)
+            self.aux_search_engine = SearchEngine(
+                mapping=AuxPassageMapping,
+                generation_file='data/aux_index_generation', **cache)
         self.datalake = C3aiAdapter()
         self.language = GPT3Adapter()
         self.web = WebAdapter()
         self.numerical = Numerical()
 
     def _get_auxiliary_url(self, msg, corrected_msg):
-        '''Select a COVID-19 related webpage URL based on input message'''
-        # TODO: Smarter URL selection or update to an actual search
+        '''Select a COVID-19 related webpage URL based on input message.
+        Only used when auxiliary passages are not indexed.'''
         msg_words = f'{msg} {corrected_msg}'.lower().split()
         macro = len(set(msg_words) & set(self.macro_words)) > 0
         if macro:
@@ -64,39 +115,90 @@ class Professor(ConfigLoader):
 
     def _get_document_urls(self, docs):
         '''Extract urls from search result documents'''
-        urls = []
-        for d in docs:
-            try:
-                # Need to remove api links because they fail to
-                # actually lead to the paper
-                url = next(
-                    u for u in d['url'].split(';')
-                    if all(w not in u.lower()
-                           for w in self.banned_url_words)
-                )
-            except StopIteration:
-                url = d['url']
-            urls.append(url)
-        return urls
+        return [self.web.pick_url(d['url'], self.banned_url_words)
+                for d in docs]
 
-    def _shorten_url(self, url):
+    def _shorten_url(self, url, deadline=None):
         '''Shortens a URL or return original URL on failure'''
         if not self.shorten_urls:
             return url
+        timeout = None if deadline is None else deadline.timeout()
         try:
-            return self.web.shorten_url(url)
+            with metrics.span('shorten_url', log=False):
+                short_url = self.web.shorten_url(url, timeout=timeout)
         except Exception as e:
             logging.error(f'Could not shorten URL "{url}" due to {e}')
             return url
+        # The shortener returns its raw response body on errors
+        return short_url if isinstance(short_url, str) else url
 
-    def _shorten_urls(self, urls, max_threads=2):
+    def _shorten_urls(self, urls, deadline=None):
         '''Shortens URLs (multithreaded)'''
-        with ThreadPool(min(len(urls), max_threads)) as pool:
-            return pool.map(self._shorten_url, urls)
+        return self._shorten_urls_async(urls, deadline)()
 
-    def _answer_textual(self, msg, corrected_msg):
-        '''Search for a textual answer to a human question'''
-        covid_crct_msg = self.input_msg_header + corrected_msg
+    def _shorten_urls_async(self, urls, deadline=None):
+        '''Start shortening URLs on the stage pool and return a function
+        that waits for the result. Known short links are looked up in bulk
+        so that only unseen URLs are sent to the shortening service.'''
+        known = self.web.get_cached_short_urls(urls) \
+            if self.shorten_urls else {}
+        misses = [u for u in dict.fromkeys(urls) if u not in known]
+        metrics.inc('short_link_cache_hits', len(urls) - len(misses))
+        metrics.inc('short_link_cache_misses', len(misses))
+        pending = self.stage_pool.starmap_async(
+            self._shorten_url, [(u, deadline) for u in misses])
+
+        def wait():
+            known.update(zip(misses, pending.get()))
+            return [known[u] for u in urls]
+        return wait
+
+    @classmethod
+    def _make_ref(cls, hit, text, fields=('body', 'abstract')):
+        '''Refer to the fragments making up text by their offsets within
+        the indexed document they were taken from. Fragments that cannot
+        be located are kept inline.'''
+        ref = []
+        index = getattr(hit.meta, 'index', None)
+        for frag in text.split('\n\n'):
+            segment = {'text': frag}
+            # Only indexed documents can be looked up by the server
+            for field in fields if index else ():
+                source = hit[field] if field in hit else None
+                start = source.find(frag) if source else -1
+                if start != -1:
+                    segment = {'index': index, 'id': hit.meta.id,
+                               'field': field, 'start': start,
+                               'end': start + len(frag)}
+                    break
+            ref.append(segment)
+        return ref
+
+    def _get_auxiliary_text(self, msg, corrected_msg, deadline=None):
+        '''Get auxiliary reference text, its URL and a reference to it,
+        either as the most relevant indexed passages or by downloading a
+        whole page'''
+        timeout = None if deadline is None else deadline.timeout()
+        if self.aux_source == 'index':
+            with metrics.span('aux_passages'):
+                passages = self.aux_search_engine.search(
+                    corrected_msg, n=self.aux_n_passages,
+                    target_fields=['body'], timeout=timeout)
+            if passages:
+                return passages[0]['url'], \
+                    '\n\n'.join(p['body'] for p in passages), \
+                    [s for p in passages for s in self._make_ref(
+                        p, p['body'], fields=('body',))]
+            logging.warning('No auxiliary passages found - '
+                            'falling back to downloading page')
+        aux_url = self._get_auxiliary_url(msg, corrected_msg)
+        with metrics.span('aux_page'):
+            _, aux_text = self.web.parse_page(
+                aux_url, page_type='wikipedia', timeout=timeout)
+        return aux_url, aux_text, [{'text': aux_text}]
+
+    def _search(self, covid_crct_msg, corrected_msg, deadline=None):
+        '''Search backend for documents relevant to the message'''
         # Extract keywords for search because they perform
         # better than simply feeding the whole message.
         # The result contains phrase parts and score in tuples.
@@ -108,13 +210,20 @@ class Professor(ConfigLoader):
         # message in search
         search_query = keyword_str if self.use_keyword_to_search \
             else corrected_msg
-        t0 = time()
-        search_results = self.search_engine.search(
-            search_query,
-            n=self.search_n_docs,
-            n_frags=self.search_n_frags,
-            frag_size=self.search_frag_size)
-        logging.info(f'Search engine took {time()-t0:.1f}s')
+        n_docs = self.search_n_docs
+        timeout = None
+        if deadline is not None:
+            timeout = deadline.timeout()
+            if deadline.below(self.degrade_thresholds['fewer_docs']):
+                deadline.degrade('fewer_docs')
+                n_docs = min(n_docs, self.degraded_search_n_docs)
+        with metrics.span('search'):
+            search_results = self.search_engine.search(
+                search_query,
+                n=n_docs,
+                n_frags=self.search_n_frags,
+                frag_size=self.search_frag_size,
+                timeout=timeout)
         # Extract fragments wthin the results
         relevant_text = [
             self.search_engine.get_highlight_frags(r)
@@ -124,47 +233,171 @@ class Professor(ConfigLoader):
         keyword_list = keyword_str.split(' ')
         search_relevance = self._calc_relevance(keyword_list, relevant_text)
         logging.info(f'Search relevance: {search_relevance:.2f}')
-        # Get auxiliary text
-        aux_url = self._get_auxiliary_url(msg, corrected_msg)
-        _, aux_text = self.web.parse_page(aux_url, page_type='wikipedia')
-        docs = [d for d in [aux_text, *relevant_text] if d]
+        return keyword_list, search_results, relevant_text
+
+    @classmethod
+    def _unless_cancelled(cls, cancel, func, *args):
+        '''Run func unless cancel has been set before it got to run'''
+        if cancel.is_set():
+            logging.info(f'Skipping cancelled {func.__name__}')
+            return None
+        return func(*args)
+
+    def _start_async(self, cancel, func, *args):
+        '''Queue func on the stage pool, skipping it if cancelled in time'''
+        return self.stage_pool.apply_async(
+            self._unless_cancelled, (cancel, func, *args))
+
+    def _start_textual_retrieval(self, msg, corrected_msg, deadline):
+        '''Start getting auxiliary text and searching in parallel.
+        Setting the returned event abandons whatever has not started yet.'''
+        covid_crct_msg = self.input_msg_header + corrected_msg
+        cancel = threading.Event()
+        pending_aux_text = None
+        if deadline.below(self.degrade_thresholds['skip_aux_page']):
+            deadline.degrade('skip_aux_page')
+        else:
+            pending_aux_text = self._start_async(
+                cancel, self._get_auxiliary_text, msg, corrected_msg,
+                deadline)
+        pending_search = self._start_async(
+            cancel, self._search, covid_crct_msg, corrected_msg, deadline)
+        return pending_aux_text, pending_search, cancel
+
+    def _get_excerpts(self, corrected_msg, docs, n_aux, deadline,
+                      refs=None):
+        '''Extract excerpts from docs (sending refs instead of the text
+        when given), falling back to the raw search fragments when short
+        on time or when extraction fails'''
+        if not deadline.below(self.degrade_thresholds['raw_fragments']):
+            try:
+                with metrics.span('excerpts'):
+                    if refs is not None:
+                        return self.web.get_excerpts_from_refs(
+                            question=corrected_msg, refs=refs,
+                            timeout=deadline.timeout(cap=50))
+                    return self.web.get_excerpts(
+                        question=corrected_msg, docs=docs,
+                        timeout=deadline.timeout(cap=50))
+            except Exception as e:
+                logging.error(f'Excerpt extraction failed due to {e}')
+        deadline.degrade('raw_fragments')
+        # Auxiliary page text is too long to be used as is
+        return [(i, d[:self.search_frag_size])
+                for i, d in enumerate(docs) if i >= n_aux]
+
+    def _answer_textual(self, msg, corrected_msg, deadline, retrieval=None):
+        '''Search for a textual answer to a human question
+
+        Independent stages are overlapped on the stage pool:
+            aux passages    ----------------------+
+            RAKE -> search -> highlight frags ----+-> excerpts -> answer
+                                                         +-> shorten URLs
+        '''
+        covid_crct_msg = self.input_msg_header + corrected_msg
+        # Retrieval may have been started speculatively already
+        if retrieval is None:
+            retrieval = self._start_textual_retrieval(
+                msg, corrected_msg, deadline)
+        pending_aux_text, pending_search, _ = retrieval
+        keyword_list, search_results, relevant_text = pending_search.get()
+        aux_url, aux_text, aux_ref = pending_aux_text.get() \
+            if pending_aux_text else (None, None, None)
+        # Keep track of each doc's URL and hit because empty docs are
+        # dropped
+        urls = [aux_url, *self._get_document_urls(search_results)]
+        hits = [None, *search_results]
+        kept = [(d, u, h) for d, u, h in
+                zip([aux_text, *relevant_text], urls, hits) if d]
+        doc_urls = [(d, u) for d, u, _ in kept]
+        docs = [d for d, _ in doc_urls]
+        refs = None
+        if self.excerpts_protocol == 'refs':
+            refs = [aux_ref if h is None else self._make_ref(h, d)
+                    for d, _, h in kept]
         total_len = sum(len(d) for d in docs)
         logging.info(
             f'Sending docs of total {total_len} chars into excerpt extraction')
-        t0 = time()
-        i_excerpts = self.web.get_excerpts(question=corrected_msg, docs=docs)
-        logging.info(f'Excerpt extraction took {time()-t0:.1f}s')
+        n_aux = 1 if aux_text else 0
+        i_excerpts = self._get_excerpts(corrected_msg, docs, n_aux, deadline,
+                                        refs=refs)
         excerpt_relevance = self._calc_relevance(
             keyword_list, [e for _, e in i_excerpts])
         logging.info(f'Excerpt relevance: {excerpt_relevance:.2f}')
         top_excerpts = i_excerpts[:self.n_excerpts_considered]
-        t0 = time()
-        answer = self.disclaimer['medical'] + \
-            self.language.extract_answer(covid_crct_msg, top_excerpts)
-        logging.info(f'Answer formatting took {time()-t0:.1f}s')
-        urls = [aux_url, *self._get_document_urls(search_results)]
-        top_urls = [urls[i] for i, _ in top_excerpts]
-        t0 = time()
-        short_urls = self._shorten_urls(top_urls)
-        logging.info(f'URL shortening took {time()-t0:.1f}s')
+        # Sources are known now so shorten them while GPT-3 is answering
+        top_urls = [doc_urls[i][1] for i, _ in top_excerpts]
+        wait_short_urls = None
+        if deadline.below(self.degrade_thresholds['skip_shorten_urls']):
+            deadline.degrade('skip_shorten_urls')
+        else:
+            wait_short_urls = self._shorten_urls_async(top_urls, deadline)
+        with metrics.span('extract_answer'):
+            answer = self.disclaimer['medical'] + \
+                self.language.extract_answer(
+                    covid_crct_msg, top_excerpts, deadline=deadline)
+        short_urls = top_urls
+        if wait_short_urls is not None:
+            with metrics.span('shorten_urls_wait'):
+                short_urls = wait_short_urls()
         return answer, short_urls
 
-    def _answer_question(self, msg, corrected_msg):
+    def _classify_question(self, corrected_msg, deadline=None):
+        '''Classify question type'''
+        with metrics.span('classify_question'):
+            return self.language.classify_question(
+                corrected_msg, deadline=deadline)
+
+    def _answer_question(self, msg, corrected_msg, deadline,
+                         question_type=None, retrieval=None):
         '''Determine question type and answer each type appropriately'''
-        question_type = self.language.classify_question(corrected_msg)
+        if question_type is None:
+            question_type = self._classify_question(corrected_msg, deadline)
         answer = ''
         urls = []
         png_filename = None
+        if question_type not in (QuestionType.Stats, QuestionType.Textual):
+            answer = 'I don\'t know how to answer that.'
+            return answer, urls, png_filename, question_type
+        # Popular textual questions are served from cache. Stats answers
+        # depend on live data and relative dates, so they are not cached.
+        generation = self.search_engine.generation()
+        use_cache = self.answer_cache is not None and \
+            question_type == QuestionType.Textual
+        if use_cache:
+            cached = self.answer_cache.get(
+                corrected_msg, question_type, generation)
+            if cached is not None:
+                metrics.inc('answer_cache_hits')
+                logging.info('Answer served from cache')
+                answer, urls, png_filename = cached
+                return answer, urls, png_filename, question_type
+            metrics.inc('answer_cache_misses')
         if question_type == QuestionType.Stats:
-            answer, png_filename = self.numerical.handle_request(corrected_msg)
+            with metrics.span('answer_stats'):
+                answer, png_filename = self.numerical.handle_request(
+                    corrected_msg, deadline=deadline)
         elif question_type == QuestionType.Textual:
-            answer, urls = self._answer_textual(msg, corrected_msg)
-        else:
-            answer = 'I don\'t know how to answer that.'
+            with metrics.span('answer_textual'):
+                answer, urls = self._answer_textual(
+                    msg, corrected_msg, deadline, retrieval=retrieval)
+        # Degraded and fallback answers are worse than usual so do not
+        # keep them around
+        if use_cache and answer and not deadline.degradations and \
+                not self._is_failsafe(answer):
+            self.answer_cache.put(corrected_msg, question_type, generation,
+                                  answer, urls, png_filename)
         return answer, urls, png_filename, question_type
 
-    def _generate_reply(self, msg):
+    @classmethod
+    def _is_failsafe(cls, reply):
+        '''Whether the reply admits not knowing the answer'''
+        return any(ph in reply.lower().strip() for ph in cls.failsafe_phrases)
+
+    def _generate_reply(self, msg, deadline=None):
         '''Returns empty string if input is to be ignored.'''
+        if deadline is None:
+            deadline = Deadline(self.latency_budget)
         # Remove any twitter handles first
         msg = re.sub(r'@(\w){1,15}', '', msg)
         msg = re.sub(r' +', ' ', msg).strip()
@@ -181,7 +414,9 @@ class Professor(ConfigLoader):
             answer = self.confused_msg
             return retvals()
         # Autocorrect message
-        corrected_msg = self.language.autocorrect(msg)
+        with metrics.span('autocorrect'):
+            corrected_msg = self.language.autocorrect(
+                msg, deadline=deadline)
         logging.info(f'Message corrected to: {corrected_msg}')
         # Check for safe words
         has_safe_word = any(r.match(corrected_msg.lower()) is not None
@@ -190,29 +425,72 @@ class Professor(ConfigLoader):
             logging.warning(f'Message has safe word: {corrected_msg}')
             # Simply ignore (answer is empty) and return early
             return retvals()
-        # Detect message intent
-        intent = self.language.get_intent(corrected_msg)
-        logging.info(f'Conversation intent is: {intent.name}')
-        if intent == IntentType.Over:
-            # Simply ignore (answer is empty)
-            pass
-        elif intent == IntentType.Confused:
-            answer = self.confused_msg
-        elif intent == IntentType.AboutMe:
-            answer = self.disclaimer['controversy'] + \
-                self.language.answer_question_about_me(corrected_msg)
-        else:
-            # Answer the question
-            answer, urls, png_filename, question_type = \
-                self._answer_question(msg, corrected_msg)
+        # Detect message intent, optionally classifying the question (and
+        # retrieving documents) at the same time on the assumption that
+        # the message is a question
+        pending_question_type = None
+        retrieval = None
+        cancel_classify = threading.Event()
+        if self.concurrent_preclassify:
+            pending_question_type = self._start_async(
+                cancel_classify, self._classify_question, corrected_msg,
+                deadline)
+            if self.speculative_retrieval:
+                retrieval = self._start_textual_retrieval(
+                    msg, corrected_msg, deadline)
+        try:
+            with metrics.span('intent'):
+                intent = self.language.get_intent(
+                    corrected_msg, deadline=deadline)
+            logging.info(f'Conversation intent is: {intent.name}')
+            if intent == IntentType.Over:
+                # Simply ignore (answer is empty)
+                pass
+            elif intent == IntentType.Confused:
+                answer = self.confused_msg
+            elif intent == IntentType.AboutMe:
+                with metrics.span('about_me'):
+                    answer = self.disclaimer['controversy'] + \
+                        self.language.answer_question_about_me(
+                            corrected_msg, deadline=deadline)
+            else:
+                if pending_question_type is not None:
+                    question_type = pending_question_type.get()
+                    if question_type != QuestionType.Textual and \
+                            retrieval is not None:
+                        retrieval[-1].set()
+                # Answer the question
+                answer, urls, png_filename, question_type = \
+                    self._answer_question(msg, corrected_msg, deadline,
+                                          question_type=question_type,
+                                          retrieval=retrieval)
+        finally:
+            # Abandon speculative work that has not started yet. This is
+            # a no-op for work that was used.
+            cancel_classify.set()
+            if retrieval is not None:
+                retrieval[-1].set()
+            if deadline.degradations:
+                logging.warning(
+                    f'Applied degradations: {deadline.degradations}')
         return retvals()
 
-    def message_handler(self, msg):
-        '''Upon receiving a message this function starts the whole Q&A process
-        '''
+    def message_handler(self, msg, reply_to_id=None):
+        '''Upon receiving a message this function queues the whole Q&A
+        process on the request pool and returns immediately'''
         logging.info(f'Received new message: {msg}')
+        self.request_pool.apply_async(
+            self._handle_message,
+            (msg, reply_to_id),
+            error_callback=lambda e: logging.error(
+                f'Failed to handle message "{msg}" due to {e}'))
+
+    def _handle_message(self, msg, reply_to_id=None):
+        '''Answer a single message and reply to it'''
         t0 = time()
-        reply, urls, png_filename, question_type = self._generate_reply(msg)
+        with metrics.span('generate_reply'):
+            reply, urls, png_filename, question_type = \
+                self._generate_reply(msg)
         if reply:
             media_ids = []
             if question_type == QuestionType.Stats and \
@@ -220,8 +498,10 @@ class Professor(ConfigLoader):
                 # upload image first
                 media = self.messaging.upload_media(png_filename)
                 media_ids = [media.media_id]
+            metrics.observe('time_to_reply_1', time() - t0)
             logging.info(f'Time to reply #1: {time()-t0:.1f}s')
-            rely_to_id = self.messaging.reply(reply, media_ids=media_ids)
+            rely_to_id = self.messaging.reply(
+                reply, reply_to_id=reply_to_id, media_ids=media_ids)
             if 'I think your question is nonsense.'.lower() in reply:
                 logging.info(
                     'Not sending sources because question is detected as nonsense.')
@@ -230,8 +510,7 @@ class Professor(ConfigLoader):
             if urls:
                 # Send sources, but repeat last url because in Twitter it
                 # disappears into a preview.
-                failsafe_phrases = ('i don\'t know.', 'i\'m not sure.')
-                if any(ph in reply.lower().strip() for ph in failsafe_phrases):
+                if self._is_failsafe(reply):
                     # Exclude wiki (first) link
                     sources_str = \
                         self.articles_might_help_heading + '\n' +\
@@ -242,13 +521,24 @@ class Professor(ConfigLoader):
                         self.references_heading + '\n' +\
                         '\n'.join(f'[{i+1}]{url}'
                                   for i, url in enumerate(urls))
+                metrics.observe('time_to_reply_2', time() - t0)
                 logging.info(f'Time to reply #2: {time()-t0:.1f}s')
                 self.messaging.reply(sources_str, reply_to_id=rely_to_id)
 
     def start(self):
         '''Main entry to start listening for messages'''
         logging.info('Listening for messages...')
-        self.messaging.listen(is_async=False)
+        logging.info(
+            f'Answering up to {self.max_concurrent_requests} messages '
+            'concurrently')
+        try:
+            self.messaging.listen(is_async=False)
+        finally:
+            # Let in-flight requests finish replying
+            self.request_pool.close()
+            self.request_pool.join()
+            self.stage_pool.close()
+            self.stage_pool.join()
 
 
 if __name__ == '__main__':
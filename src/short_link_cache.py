@@ -0,0 +1,51 @@
+# Persistent URL -> short link cache
+import os
+import sqlite3
+import threading
+
+
+class ShortLinkCache:
+    '''
+    SQLite backed map from long URLs to their short links. Short links
+    never expire so entries are kept forever.
+    '''
+    # SQLite limits the number of host parameters per statement
+    max_batch = 500
+
+    def __init__(self, path='data/short_links.sqlite'):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS short_links ('
+            ' url TEXT PRIMARY KEY,'
+            ' short_url TEXT)')
+        self.conn.commit()
+
+    def get_many(self, urls):
+        '''Look up URLs in bulk and return {url: short_url} for hits'''
+        urls = list(set(urls))
+        found = {}
+        with self.lock:
+            for i in range(0, len(urls), self.max_batch):
+                batch = urls[i:i+self.max_batch]
+                placeholders = ','.join('?' * len(batch))
+                found.update(self.conn.execute(
+                    'SELECT url, short_url FROM short_links '
+                    f'WHERE url IN ({placeholders})', batch).fetchall())
+        return found
+
+    def get(self, url):
+        return self.get_many([url]).get(url)
+
+    def put(self, url, short_url):
+        self.put_many({url: short_url})
+
+    def put_many(self, short_urls):
+        '''Store {url: short_url}'''
+        with self.lock:
+            self.conn.executemany(
+                'INSERT OR REPLACE INTO short_links VALUES (?, ?)',
+                list(short_urls.items()))
+            self.conn.commit()
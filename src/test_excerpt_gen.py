@@ -0,0 +1,156 @@
+# Unit tests for the model-independent parts of excerpt generation.
+# Usage (from src/):
+#   python -m unittest test_excerpt_gen
+import re
+import unittest
+
+import numpy as np
+
+from base.lru_cache import LRUCache
+from excerpt_gen import bm25_scores, find_answers, sentence_bounds, \
+    token_windows
+
+
+class FakeTokenizer:
+    '''Whitespace tokenizer with the parts of the transformers tokenizer
+    API that find_answers uses'''
+    pad_id, cls_id, sep_id = 0, 1, 2
+
+    def __init__(self):
+        self.vocab = {}
+
+    def token_id(self, word):
+        return self.vocab.setdefault(word.lower(), len(self.vocab) + 3)
+
+    def __call__(self, text, add_special_tokens=False,
+                 return_offsets_mapping=False):
+        spans = [m.span() for m in re.finditer(r'\S+', text)]
+        enc = {'input_ids': [self.token_id(text[s:e]) for s, e in spans]}
+        if return_offsets_mapping:
+            enc['offset_mapping'] = spans
+        return enc
+
+    def build_inputs_with_special_tokens(self, q_ids, ctx_ids):
+        return [self.cls_id] + q_ids + [self.sep_id] + ctx_ids + \
+            [self.sep_id]
+
+    def create_token_type_ids_from_sequences(self, q_ids, ctx_ids):
+        return [0] * (len(q_ids) + 2) + [1] * (len(ctx_ids) + 1)
+
+    def num_special_tokens_to_add(self, pair=False):
+        return 3 if pair else 2
+
+    def pad(self, features, return_attention_mask=True,
+            return_tensors='pt'):
+        import torch
+        n = max(len(ids) for ids in features['input_ids'])
+        batch = {k: torch.tensor([x + [self.pad_id] * (n - len(x))
+                                  for x in v])
+                 for k, v in features.items()}
+        batch['attention_mask'] = torch.tensor(
+            [[1] * len(x) + [0] * (n - len(x))
+             for x in features['input_ids']])
+        return batch
+
+
+class FakeModel:
+    '''Answers with the first occurrence of answer_word in each window'''
+    device = 'cpu'
+
+    def __init__(self, answer_word):
+        self.tokenizer = FakeTokenizer()
+        self.answer_id = self.tokenizer.token_id(answer_word)
+        self.model = self
+        self.n_windows = 0
+
+    def __call__(self, input_ids, **kwargs):
+        self.n_windows += len(input_ids)
+        logits = (input_ids == self.answer_id).float() * 10
+        return logits, logits
+
+
+class TestTokenWindows(unittest.TestCase):
+    def test_short_context_is_one_window(self):
+        self.assertEqual(token_windows(3, 8, 2), [(0, 3)])
+        self.assertEqual(token_windows(8, 8, 2), [(0, 8)])
+
+    def test_windows_cover_all_tokens(self):
+        for n_tokens in range(9, 40):
+            windows = token_windows(n_tokens, 8, 3)
+            covered = set()
+            for start, end in windows:
+                self.assertEqual(end - start, 8)
+                covered.update(range(start, end))
+            self.assertEqual(covered, set(range(n_tokens)))
+            for (_, end), (start, _) in zip(windows, windows[1:]):
+                self.assertGreaterEqual(end - start, 3)
+
+    def test_last_window_is_shifted_back(self):
+        self.assertEqual(token_windows(10, 4, 1), [(0, 4), (3, 7), (6, 10)])
+        self.assertEqual(token_windows(11, 4, 1),
+                         [(0, 4), (3, 7), (6, 10), (7, 11)])
+
+
+class TestBM25Scores(unittest.TestCase):
+    def test_only_matching_windows_score(self):
+        scores = bm25_scores([[5, 6], [7, 8, 9], [5, 5, 7]], [5])
+        self.assertGreater(scores[0], 0)
+        self.assertEqual(scores[1], 0)
+        self.assertGreater(scores[2], scores[0])
+
+    def test_repeated_query_terms_count_once(self):
+        windows = [[5, 6], [7, 8, 9], [5, 5, 7]]
+        np.testing.assert_allclose(bm25_scores(windows, [5, 5, 7]),
+                                   bm25_scores(windows, [7, 5]))
+
+
+class TestSentenceBounds(unittest.TestCase):
+    def test_bounds(self):
+        starts, ends = sentence_bounds('One. Two... Three.')
+        self.assertEqual(starts.tolist(), [5])
+        self.assertEqual(ends.tolist(), [4, 9, 18])
+
+    def test_cached_by_content(self):
+        cache = LRUCache(max_entries=4)
+        starts, ends = sentence_bounds('One. Two.', cache)
+        cached_starts, cached_ends = sentence_bounds('One. Two.', cache)
+        self.assertIs(cached_starts, starts)
+        self.assertIs(cached_ends, ends)
+        self.assertEqual(len(cache), 1)
+
+
+class TestFindAnswers(unittest.TestCase):
+    def test_no_pairs(self):
+        self.assertEqual(find_answers(FakeModel('x'), []), [])
+
+    def test_empty_context_gets_empty_answer(self):
+        model = FakeModel('cough')
+        answers = find_answers(model, [
+            ('What?', ''), ('What?', 'Fever, cough and fatigue')])
+        self.assertEqual(answers[0]['answer'], '')
+        self.assertEqual(answers[0]['score'], 0.0)
+        self.assertEqual(answers[1]['answer'], 'cough')
+        self.assertEqual(model.n_windows, 1)
+
+    def test_offsets_map_to_context_chars(self):
+        context = ' '.join(f'word{i}' for i in range(40)) + \
+            '  Symptoms:   fever'
+        answers = find_answers(FakeModel('fever'), [('Which?', context)],
+                               batch_size=2, max_seq_len=12, doc_stride=3)
+        start, end = answers[0]['start'], answers[0]['end']
+        self.assertEqual((start, end), (len(context) - 5, len(context)))
+        self.assertEqual(answers[0]['answer'], 'fever')
+
+    def test_prefilter_budget_is_per_pair(self):
+        context = ' '.join(f'word{i}' for i in range(40)) + ' fever'
+        pairs = [('Which fever', context), ('Which fever', context)]
+        kwargs = dict(max_seq_len=12, doc_stride=3, top_k=1)
+        alone = find_answers(FakeModel('fever'), pairs[:1], **kwargs)
+        together = find_answers(FakeModel('fever'), pairs, **kwargs)
+        self.assertEqual(alone[0], together[0])
+        self.assertEqual(together[0], together[1])
+        self.assertEqual(alone[0]['answer'], 'fever')
+
+
+if __name__ == '__main__':
+    unittest.main()